@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of pkpcli on synthetic KeePass DBs.
+
+Generates DBs of the given sizes (entries spread on a tree of
+groups), times the operations of the shell that depend on the
+size of the DB and prints (or writes) the results as JSON, so
+that runs of different versions can be compared:
+
+    python bench.py -o before.json
+    ... change something ...
+    python bench.py --compare before.json
+
+bench.py --check only runs the regression checks of the shell.
+"""
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+import cli
+
+PASSWORD = 'bench'
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november',
+         'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango')
+
+
+def make_db(path, entries, fanout=8, depth=3, rounds=50000, seed=0):
+    """
+    Creates a DB at path with entries entries, spread randomly
+    on a tree of groups fanout wide and up to depth levels deep
+    (every branch stops at a random level, so the nesting varies)
+    """
+    import pkpdb
+
+    rnd = random.Random(seed)
+    db = pkpdb.PkpDatabase(path, password=PASSWORD, new=True)
+    groups = []
+    level = [None]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            if parent is not None and rnd.random() < 0.3:
+                continue # this branch stops here
+            for i in range(fanout):
+                g = db.create_group(title=u'%s%d' % (rnd.choice(WORDS), i),
+                                    parent=parent)
+                groups.append(g)
+                next_level.append(g)
+        level = next_level
+    for n in xrange(entries):
+        g = rnd.choice(groups)
+        word = rnd.choice(WORDS)
+        g.create_entry(title=u'%s-%06d' % (word, n),
+                       username=u'%s%d' % (rnd.choice(WORDS), n % 97),
+                       password=u'%016x' % rnd.getrandbits(64),
+                       url=u'https://%s%d.example.com/' % (word, n % 1000),
+                       notes=u' '.join(rnd.sample(WORDS, 4)))
+    db.save(password=PASSWORD)
+    # new DBs always get 50000 rounds
+    if rounds != db.header.key_enc_rounds:
+        db.header.key_enc_rounds = rounds
+        db.save(password=PASSWORD)
+    db.close()
+
+
+def timeit(f, repeat, min_time=0.02):
+    """
+    Calls f repeat times (each run loops on f long enough to
+    take min_time seconds, for the fast operations); returns
+    the stats of the time per call (in ms)
+    """
+    number = 1
+    while True:
+        t = time.time()
+        for i in xrange(number):
+            f()
+        if time.time() - t >= min_time or number >= 10 ** 6:
+            break
+        number *= 10
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        for i in xrange(number):
+            f()
+        times.append((time.time() - t) * 1000 / number)
+    times.sort()
+    return dict(min=round(times[0], 4),
+                median=round(times[len(times) // 2], 4),
+                max=round(times[-1], 4),
+                runs=repeat, loops=number)
+
+
+def bench_db(path, repeat):
+    """
+    Times the shell operations on the DB at path
+    """
+    results = dict()
+    shell = cli.PkpCli(batch=True)
+
+    def open_close():
+        shell._open_db(path, password=PASSWORD)
+        shell._close_db()
+    results['open'] = timeit(open_close, repeat)
+
+    shell._open_db(path, password=PASSWORD)
+    db = shell.db
+
+    # the biggest group and the deepest one
+    big = max(db.groups, key=lambda g: len(g.entries))
+    deep = max(db.groups, key=lambda g: g.level)
+    big_path = shell._group_path(big)
+    deep_path = shell._group_path(deep)
+    some = big.entries[len(big.entries) // 2]
+    prefix = some.title[:len(some.title) - 2]
+
+    def save():
+        shell._mark_dirty()
+        shell.do_save()
+    results['save'] = timeit(save, repeat)
+
+    shell.cwd = big
+    def childrens_cold():
+        shell._touch(big)
+        shell._current_childrens()
+    results['childrens_cold'] = timeit(childrens_cold, repeat)
+    results['childrens'] = timeit(shell._current_childrens, repeat)
+
+    def cd():
+        shell.do_cd(deep_path)
+        shell.do_cd('/')
+        shell.do_cd(big_path)
+    results['cd'] = timeit(cd, repeat)
+
+    line = 'show ' + prefix
+    results['complete'] = timeit(
+        lambda: shell.complete_show(prefix, line, 5, len(line)), repeat)
+    line = 'cd ' + deep_path[:-1]
+    results['complete_path'] = timeit(
+        lambda: shell.complete_cd(deep_path[:-1], line, 3, len(line)), repeat)
+
+    # built on the first search: not part of the timings
+    shell.index._build_pending()
+    results['find_substring'] = timeit(lambda: shell._find(some.username), repeat)
+    results['find_prefix'] = timeit(lambda: shell._find(prefix, prefix=True), repeat)
+    results['find_glob'] = timeit(lambda: shell._find('*%s*' % some.title[-4:]), repeat)
+    results['find_fuzzy'] = timeit(
+        lambda: shell._find_fuzzy('%s %s' % (prefix[:-1], some.username)), repeat)
+
+    results['ls_R'] = timeit(
+        lambda: list(shell._ls_lines(db.root, recursive=True, long=True)), repeat)
+    shell._close_db()
+    return results
+
+
+def bench_new_db(workdir, repeat):
+    """
+    Times the creation of a new DB by the shell (journal on)
+    """
+    path = os.path.join(workdir, 'bench-new.kdb')
+    shell = cli.PkpCli(batch=True, journal=True)
+
+    def create():
+        shell._open_db(path, password=PASSWORD)
+        shell._close_db()
+        os.remove(path)
+    return dict(create=timeit(create, repeat))
+
+
+def bench_passwords(repeat, count=1000):
+    gen = cli.PasswordGenerator()
+    results = dict()
+    results['password_x%d' % count] = timeit(
+        lambda: [gen.password(20, 'luds') for i in xrange(count)], repeat)
+    try:
+        gen.wordlist()
+    except ValueError:
+        return results
+    results['passphrase_x%d' % count] = timeit(
+        lambda: [gen.passphrase(5) for i in xrange(count)], repeat)
+    return results
+
+
+def check_readonly_journal(path):
+    """
+    A read-only open replays the journal left by a writer in
+    memory only: closing it must not ask to save
+    """
+    writer = cli.PkpCli(batch=True, journal=True)
+    writer._open_db(path, password=PASSWORD)
+    writer.onecmd('mkdir /journaled')
+    writer.postcmd(False, 'mkdir /journaled')
+    writer.db.close() # as if it crashed: the journal is left
+
+    reader = cli.PkpCli()
+    def confirm(*args, **kwargs):
+        raise AssertionError('asked to save a read-only DB')
+    reader._confirm = confirm
+    reader._open_db(path, password=PASSWORD, readonly=True)
+    assert reader._group_for_path('/journaled') is not None, 'journal not replayed'
+    assert not reader.need_save, 'read-only DB marked as changed'
+    reader._close_db()
+
+
+def check_save_as(path):
+    """
+    After save as, the vault is the new file: open finds it
+    there, and the old file opens as another vault
+    """
+    new = path + '.new.kdb'
+    shell = cli.PkpCli(batch=True)
+    shell._open_db(path, password=PASSWORD)
+    vault = shell.vault
+    try:
+        shell.onecmd('mkdir /saved_as')
+        shell.do_save(new)
+        assert vault.path == os.path.realpath(new), 'vault path not updated'
+        shell._open_db(new, password=PASSWORD)
+        assert shell.vault is vault, 'save as target opened again'
+        shell._open_db(path, password=PASSWORD)
+        assert shell.vault is not vault, 'old file taken for the vault'
+        assert shell._group_for_path('/saved_as') is None, 'old file has the new changes'
+    finally:
+        shell._close_all()
+        os.remove(new)
+
+
+def check_serve_reload(path):
+    """
+    A served (read-only) DB is read again once saved by
+    another process, as serve() does before every command
+    """
+    from StringIO import StringIO
+    import pkpdb
+
+    shell = cli.PkpCli(batch=True)
+    shell._open_db(path, password=PASSWORD, readonly=True)
+    entry = shell.db.entries[0]
+    get = cli.oneshot_parser().parse_args(
+        ['get', '-f', 'password',
+         shell._group_path(entry.group).rstrip('/') + '/' + entry.title])
+    def lookup():
+        shell._reload(path)
+        out = StringIO()
+        assert shell.run_oneshot(get, out) == 0, 'lookup failed'
+        return out.getvalue().strip()
+    try:
+        before = lookup()
+        writer = pkpdb.PkpDatabase(path, password=PASSWORD)
+        [e for e in writer.entries if e.uuid == entry.uuid][0].password = before + u'-rotated'
+        writer.save(password=PASSWORD)
+        writer.close()
+        assert lookup() == before + '-rotated', 'served an old copy of the DB'
+    finally:
+        shell._close_all()
+
+
+CHECKS = (check_readonly_journal, check_save_as, check_serve_reload)
+
+def run_checks(workdir, out=sys.stderr):
+    """
+    Runs the CHECKS (regressions of the shell found while
+    benchmarking), each on a new small DB; returns the
+    number of failures
+    """
+    failures = 0
+    for check in CHECKS:
+        path = os.path.join(workdir, 'check-%s.kdb' % check.__name__)
+        make_db(path, 50, rounds=1000)
+        try:
+            check(path)
+        except Exception, e:
+            print >>out, 'FAIL %s: %s' % (check.__name__, e)
+            failures += 1
+        else:
+            print >>out, 'ok   %s' % check.__name__
+        for f in (path, path + '.lock', path + '.journal'):
+            if os.path.exists(f):
+                os.remove(f)
+    return failures
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """
+    Prints the ratio between results and baseline for every
+    timing (on the medians); returns the number of regressions
+    (ratio above threshold)
+    """
+    regressions = 0
+    for size, ops in sorted(results['results'].items()):
+        base = baseline['results'].get(size)
+        if not base:
+            continue
+        for op, r in sorted(ops.items()):
+            if op not in base or not base[op]['median']:
+                continue
+            ratio = r['median'] / base[op]['median']
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print >>out, '%-8s %-20s %10.3f ms %10.3f ms %6.2fx%s' % (
+                size, op, base[op]['median'], r['median'], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of pkpcli on synthetic DBs')
+    parser.add_argument('-s','--sizes',default='1000,10000',
+                        help='Comma separated numbers of entries (default 1000,10000)')
+    parser.add_argument('--fanout',type=int,default=8,
+                        help='Subgroups of every group (default 8)')
+    parser.add_argument('--depth',type=int,default=3,
+                        help='Maximum nesting of the groups (default 3)')
+    parser.add_argument('--rounds',type=int,default=50000,
+                        help='Key transformation rounds of the DBs (default 50000)')
+    parser.add_argument('-r','--repeat',type=int,default=5,
+                        help='Runs of every operation (default 5)')
+    parser.add_argument('-d','--dir',
+                        help='Keep the generated DBs in DIR (and reuse them)')
+    parser.add_argument('-o','--output',metavar='FILE',
+                        help='Write the results to FILE instead of stdout')
+    parser.add_argument('-c','--compare',metavar='FILE',
+                        help='Compare with the results in FILE; the exit '
+                        'status is 1 if something got slower than --threshold')
+    parser.add_argument('--check',action='store_true',
+                        help='Only run the regression checks of the shell; the '
+                        'exit status is 1 if one fails')
+    parser.add_argument('--threshold',type=float,default=1.25,
+                        help='Slowdown ratio counted as regression (default 1.25)')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    workdir = args.dir or tempfile.mkdtemp(prefix='pkpbench')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = dict(python=platform.python_version(),
+                   platform=platform.platform(),
+                   time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   params=dict(fanout=args.fanout, depth=args.depth,
+                               rounds=args.rounds, repeat=args.repeat),
+                   results=dict())
+    # the shell is chatty, only the results go to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    if args.check:
+        try:
+            failures = run_checks(workdir)
+        finally:
+            sys.stdout = stdout
+            if not args.dir:
+                shutil.rmtree(workdir, ignore_errors=True)
+        sys.exit(1 if failures else 0)
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'bench-%d-%d-%d-%d.kdb' % (
+                size, args.fanout, args.depth, args.rounds))
+            if not os.path.isfile(path):
+                print >>sys.stderr, 'Generating %s' % path
+                make_db(path, size, args.fanout, args.depth, args.rounds)
+            print >>sys.stderr, 'Running %d entries' % size
+            results['results'][str(size)] = bench_db(path, args.repeat)
+        results['results']['new'] = bench_new_db(workdir, args.repeat)
+        results['results']['passwords'] = bench_passwords(args.repeat)
+    finally:
+        sys.stdout = stdout
+        if not args.dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,980 @@
 #!/usr/bin/env python
 
+import sys
+import time
+
+STARTED = time.time()
+IMPORT_TIMES = [] # (depth, module, seconds), see --profile-startup
+STARTUP_PRINTED = []
+
+def _profile_imports():
+    """
+    Wraps __import__ to record how long every module takes
+    to be imported (including the lazy imports done later)
+    """
+    import __builtin__
+    real_import = __builtin__.__import__
+    depth = [0]
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return real_import(name, *args, **kwargs)
+        depth[0] += 1
+        start = time.time()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            depth[0] -= 1
+            IMPORT_TIMES.append((depth[0], name, time.time() - start))
+
+    __builtin__.__import__ = timed_import
+
+if '--profile-startup' in sys.argv:
+    _profile_imports()
+    # also printed when the startup ends early (--help, bad options)
+    import atexit
+    atexit.register(lambda: print_startup_profile())
+
+# Keep the module level imports light: keepassdb, the crypto
+# backend (see pkpdb) and the modules used by a few commands
+# only are imported when needed.
 import cmd
 import argparse
-import dircache
 import getpass
-import sys
 import os
-import tempfile
-import subprocess
+import re
+import bisect
+import heapq
+import math
+import fnmatch
 from functools import wraps
-import keepassdb
+from contextlib import contextmanager
+from collections import OrderedDict
 import getopt
-import logging
-from keepassdb import LockingDatabase
 try:
-    import ConfigParser
+    from os import scandir
 except ImportError:
-    from configparser import ConfigParser
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def print_startup_profile(out=sys.stderr):
+    """
+    Prints the imports recorded by _profile_imports(), slowest
+    first (nested imports are indented below their importer).
+    Prints nothing when called again
+    """
+    if STARTUP_PRINTED:
+        return
+    STARTUP_PRINTED.append(True)
+    total = time.time() - STARTED
+    print >>out, 'Startup: %.1f ms' % (total * 1000)
+    # IMPORT_TIMES is in completion order: the imports done by a
+    # module are recorded before the module itself
+    pending = dict()
+    for depth, name, seconds in IMPORT_TIMES:
+        node = (seconds, name, pending.pop(depth + 1, []))
+        pending.setdefault(depth, []).append(node)
+    tree = pending.get(0, [])
+
+    def _print(nodes, indent):
+        for seconds, name, children in sorted(nodes, reverse=True):
+            print >>out, '%8.2f ms  %s%s' % (seconds * 1000, '  ' * indent, name)
+            _print(children, indent + 1)
+    _print(tree, 0)
+
+def oneshot_parser():
+    """
+    Parser of the commands that can be run without a shell,
+    see PkpCli.run_oneshot()
+    """
+    parser = argparse.ArgumentParser(
+        prog='cli.py -d DBFILE',
+        description='Run a single command and exit')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('get', help='Print an entry (JSON) or one of its fields')
+    p.add_argument('path', metavar='PATH')
+    p.add_argument('-f','--field', choices=PkpCli.ENTRY_FIELDS,
+                   help='Print only FIELD')
+    p.add_argument('--password', action='store_true',
+                   help='Include the password in the JSON output')
+
+    p = sub.add_parser('ls', help='List a group, groups end with /')
+    p.add_argument('path', metavar='PATH', nargs='?', default='/')
+    p.add_argument('--json', action='store_true', help='JSON output')
+
+    p = sub.add_parser('find', help='Print the paths matching QUERY')
+    p.add_argument('query', metavar='QUERY', nargs='+')
+    p.add_argument('-p','--prefix', action='store_true', help='Prefix match')
+    p.add_argument('-z','--fuzzy', action='store_true',
+                   help='Best approximate matches of the words of QUERY')
+    p.add_argument('-n','--limit', type=int, default=20,
+                   help='Number of fuzzy matches (default 20)')
+    p.add_argument('-f','--field', action='append',
+                   choices=EntryIndex.ENTRY_FIELDS, help='Search only FIELD')
+    p.add_argument('--json', action='store_true', help='JSON output')
+    return parser
+
+DEFAULT_SOCKET = '~/.pkpcli.sock'
+
+def serve(shell, path):
+    """
+    Keeps the DB opened by shell in memory and answers the one-shot
+    commands sent by client() on the Unix socket path, until
+    interrupted. Every connection is served by its own thread;
+    the commands themselves are serialized by a lock.
+
+    The DB is read again before a command if its file was saved
+    meanwhile (the transformed key is cached, see pkpdb.KeyCache,
+    so that costs no key derivation when the seed is unchanged).
+
+    The socket is only accessible by the owner and connections
+    from other users are refused (SO_PEERCRED, Linux only).
+    """
+    import json
+    import socket
+    import struct
+    import threading
+    import SocketServer
+    from StringIO import StringIO
+
+    lock = threading.Lock()
+    dbfile = shell.db.filepath
+    if not shell.key_cache:
+        import pkpdb
+        shell.key_cache = pkpdb.KeyCache()
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def _allowed(self):
+            if not sys.platform.startswith('linux'):
+                return True
+            creds = self.request.getsockopt(
+                socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17),
+                struct.calcsize('3i'))
+            pid, uid, gid = struct.unpack('3i', creds)
+            return uid == os.getuid()
+
+        def handle(self):
+            if not self._allowed():
+                return
+            for line in self.rfile:
+                out, err = StringIO(), StringIO()
+                try:
+                    with lock:
+                        # argparse prints its help and errors on
+                        # sys.stdout and sys.stderr: send them back
+                        stdout, stderr = sys.stdout, sys.stderr
+                        sys.stdout, sys.stderr = out, err
+                        try:
+                            opts = oneshot_parser().parse_args(json.loads(line))
+                        finally:
+                            sys.stdout, sys.stderr = stdout, stderr
+                        shell._reload(dbfile)
+                        status = shell.run_oneshot(opts, out, err)
+                except SystemExit, e:
+                    status = e.code
+                except Exception, e:
+                    print >>err, 'Error: %s' % e
+                    status = 2
+                self.wfile.write(json.dumps(dict(status=status,
+                                                 out=out.getvalue(),
+                                                 err=err.getvalue())) + '\n')
+                self.wfile.flush()
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    path = os.path.expanduser(path)
+    if os.path.exists(path):
+        try:
+            socket.socket(socket.AF_UNIX).connect(path)
+        except socket.error:
+            os.remove(path) # stale socket
+        else:
+            print >>sys.stderr, 'Another server is listening on %s' % path
+            return 1
+
+    umask = os.umask(0177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    print >>sys.stderr, 'Serving %s on %s' % (shell.db.filepath, path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+    return 0
+
+def client(path, argv, out=sys.stdout, err=sys.stderr):
+    """
+    Sends a one-shot command (argv, already validated by
+    oneshot_parser()) to serve() and prints its answer.
+    Returns the exit status
+    """
+    import json
+    import socket
+
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.connect(os.path.expanduser(path))
+        s.sendall(json.dumps(argv) + '\n')
+        answer = json.loads(s.makefile().readline())
+    except (socket.error, ValueError), e:
+        print >>err, 'Cannot talk to the server on %s: %s' % (path, e)
+        return 2
+    finally:
+        s.close()
+    out.write(answer['out'].encode('utf-8'))
+    err.write(answer['err'].encode('utf-8'))
+    return answer['status']
+
+class EntryIndex(object):
+    """
+    In-memory inverted index over the whole DB tree.
+
+    Entries are indexed by title, username, URL and notes,
+    groups by title only. The index is built once (on the first
+    query, see defer()) and then kept up to date by the shell
+    commands, so queries never walk db.root again. From then on
+    it keeps a lowercased copy of those fields (notes included,
+    passwords never) in memory, whatever LazyEntry drops.
+    """
+    ENTRY_FIELDS = ('title', 'username', 'url', 'notes')
+    GROUP_FIELDS = ('title',)
+    GLOB_CHARS = re.compile(r'[*?\[]')
+
+    def __init__(self):
+        self.items = dict()     # id -> entry or group
+        self.values = dict()    # id -> {field: lowercased value}
+        self.trigrams = dict()  # trigram -> set of ids
+        self.sorted_values = [] # sorted (lowercased value, id) for prefix
+        self.pending = None     # DB to index on the first query
+
+    def build(self, db):
+        """
+        Index all the groups and entries of db
+        """
+        # sorted once at the end, not inserted one by one
+        for g in db.groups:
+            self.add(g, insort=False)
+        for e in db.entries:
+            self.add(e, insort=False)
+        self.sorted_values.sort()
+
+    def defer(self, db):
+        """
+        Indexes db on the first query instead of now: indexing
+        decrypts the fields of all the entries (see pkpdb.LazyEntry)
+        """
+        self.pending = db
+
+    def _build_pending(self):
+        if self.pending is not None:
+            db, self.pending = self.pending, None
+            self.build(db)
+
+    def _fields(self, item):
+        if hasattr(item, 'children'):
+            return self.GROUP_FIELDS
+        return self.ENTRY_FIELDS
+
+    def _trigrams(self, value):
+        return set(value[i:i+3] for i in range(len(value) - 2))
+
+    def add(self, item, insort=True):
+        """
+        Add (or re-add) a group or entry to the index
+        """
+        if self.pending is not None:
+            return
+        key = id(item)
+        if key in self.items:
+            self.remove(item)
+        values = dict()
+        for field in self._fields(item):
+            value = (getattr(item, field, None) or '').lower()
+            if not value:
+                continue
+            values[field] = value
+            if insort:
+                bisect.insort(self.sorted_values, (value, key))
+            else:
+                self.sorted_values.append((value, key))
+            for t in self._trigrams(value):
+                self.trigrams.setdefault(t, set()).add(key)
+        self.items[key] = item
+        self.values[key] = values
+
+    def remove(self, item):
+        """
+        Remove a group or entry using the values it was indexed with,
+        so it works even after the item has been modified
+        """
+        if self.pending is not None:
+            return
+        key = id(item)
+        if key not in self.items:
+            return
+        for value in self.values[key].values():
+            i = bisect.bisect_left(self.sorted_values, (value, key))
+            if i < len(self.sorted_values) and self.sorted_values[i] == (value, key):
+                del self.sorted_values[i]
+            for t in self._trigrams(value):
+                s = self.trigrams.get(t)
+                if s is None:
+                    continue
+                s.discard(key)
+                if not s:
+                    del self.trigrams[t]
+        del self.items[key]
+        del self.values[key]
+
+    def _candidates(self, literal):
+        """
+        Returns the ids that may contain literal, or None
+        if the literal is too short to use the trigrams
+        """
+        if len(literal) < 3:
+            return None
+        grams = sorted(self._trigrams(literal),
+                       key=lambda t: len(self.trigrams.get(t, ())))
+        result = None
+        for t in grams:
+            s = self.trigrams.get(t)
+            if not s:
+                return set()
+            result = set(s) if result is None else result & s
+            if not result:
+                break
+        return result
+
+    def _match(self, keys, test, fields=None):
+        if keys is None:
+            keys = self.values.iterkeys()
+        for key in keys:
+            for field, value in self.values[key].iteritems():
+                if fields and field not in fields:
+                    continue
+                if test(value):
+                    yield self.items[key]
+                    break
+
+    def substring(self, text, fields=None):
+        """
+        Items having text in one of their fields
+        """
+        self._build_pending()
+        text = text.lower()
+        return list(self._match(self._candidates(text),
+                                lambda v: text in v, fields))
+
+    def prefix(self, text, fields=None):
+        """
+        Items having a field starting with text
+        """
+        self._build_pending()
+        text = text.lower()
+        i = bisect.bisect_left(self.sorted_values, (text,))
+        keys = set()
+        while i < len(self.sorted_values):
+            value, key = self.sorted_values[i]
+            if not value.startswith(text):
+                break
+            keys.add(key)
+            i += 1
+        return list(self._match(keys, lambda v: v.startswith(text), fields))
+
+    def glob(self, pattern, fields=None):
+        """
+        Items having a field matching the shell-like pattern
+        """
+        self._build_pending()
+        pattern = pattern.lower()
+        regex = re.compile(fnmatch.translate(pattern))
+        literals = [l for l in re.split(r'\*|\?|\[[^\]]*\]', pattern) if l]
+        keys = None
+        if literals:
+            keys = self._candidates(max(literals, key=len))
+        if keys is None and not self.GLOB_CHARS.match(pattern):
+            # anchored pattern, the literal head can be used as prefix
+            head = self.GLOB_CHARS.split(pattern, 1)[0]
+            keys = set(id(i) for i in self.prefix(head))
+        return list(self._match(keys, regex.match, fields))
+
+    def query(self, text, fields=None):
+        """
+        Glob query if text contains wildcards, substring otherwise
+        """
+        if self.GLOB_CHARS.search(text):
+            return self.glob(text, fields)
+        return self.substring(text, fields)
+
+    FUZZY_FIELDS = ('username', 'url')
+    FUZZY_POSTINGS = 20000 # trigram postings counted by a query
+    FUZZY_CANDIDATES = 100 # candidates scored by a query
+    WORD_START = '/ .-_@:'
+
+    def score(self, word, text):
+        """
+        How well word matches text, from 1 (a substring starting
+        a word of text) down to its letters found in order but
+        spread out; a word with typos only gets a fraction of the
+        trigrams it shares with text; 0 for no match at all
+        """
+        i = text.find(word)
+        if i == 0 or (i > 0 and text[i - 1] in self.WORD_START):
+            return 1.0
+        best = 0.0
+        start = text.find(word[0])
+        while start >= 0:
+            pos, adjacent, matched = start, 0, 1
+            for c in word[1:]:
+                p = text.find(c, pos + 1)
+                if p < 0:
+                    break
+                if p == pos + 1:
+                    adjacent += 1
+                pos = p
+                matched += 1
+            if matched < len(word):
+                break # no later start can match all the letters either
+            word_start = start == 0 or text[start - 1] in self.WORD_START
+            best = max(best, (adjacent + 1 + word_start) / (len(word) + 1.0))
+            start = text.find(word[0], start + 1)
+        grams = self._trigrams(word)
+        if grams and best < 0.5:
+            best = max(best, 0.5 * sum(1 for t in grams if t in text) / len(grams))
+        return best
+
+    def fuzzy(self, text, path=None, limit=20):
+        """
+        Returns the (score, item) of the limit items best matching
+        the words of text, also when misspelled or abbreviated,
+        best first. The candidates are the items sharing the most
+        (and rarest) trigrams with the words (or, when too few, the
+        trigrams containing their bigrams or starting with their
+        first letter), or starting with the short ones; each word is scored (see score()) against
+        their path (path(item), default the title), username and
+        url, and the item gets the average
+        """
+        self._build_pending()
+        words = text.lower().split()
+        grams = set()
+        for w in words:
+            grams |= self._trigrams(w)
+        counts = dict()
+
+        def count(postings):
+            budget = self.FUZZY_POSTINGS
+            for n, keys in enumerate(sorted(postings, key=len)):
+                # the rarest trigram is always counted, the common ones
+                # (that match almost everything) only if within budget
+                if n and len(keys) > budget:
+                    break
+                budget -= len(keys)
+                weight = math.log(1.0 + float(len(self.items)) / len(keys))
+                for key in keys:
+                    counts[key] = counts.get(key, 0) + weight
+        count([self.trigrams[t] for t in grams if t in self.trigrams])
+        fallback = len(counts) < self.FUZZY_CANDIDATES
+        if fallback:
+            # abbreviations ("prd", "qbc") share few trigrams with
+            # what they stand for: add the items with the trigrams
+            # containing their bigrams, and below the ones starting
+            # with their first letter; score() sorts them out
+            bigrams = set(w[i:i + 2] for w in words for i in range(len(w) - 1))
+            count([keys for t, keys in self.trigrams.iteritems()
+                   if t[:2] in bigrams or t[1:] in bigrams])
+        for w in words:
+            if len(w) >= 3:
+                if not fallback:
+                    continue
+                w = w[0]
+            i = bisect.bisect_left(self.sorted_values, (w,))
+            for value, key in self.sorted_values[i:i + self.FUZZY_CANDIDATES]:
+                if not value.startswith(w):
+                    break
+                counts.setdefault(key, 0)
+
+        result = []
+        for key in heapq.nlargest(self.FUZZY_CANDIDATES, counts, key=counts.get):
+            item = self.items[key]
+            values = self.values[key]
+            name = path(item) if path else item.title or u''
+            target = u' '.join([name.lower()] + [values.get(f, u'') for f in self.FUZZY_FIELDS])
+            score = sum(self.score(w, target) for w in words) / len(words)
+            if score:
+                result.append((score, name, item))
+        result.sort(key=lambda r: (-r[0], len(r[1]), r[1]))
+        return [(score, item) for score, name, item in result[:limit]]
+
+class FileCompleter(object):
+    """
+    Filename completion for the open/save commands.
+
+    Directory listings are cached and reused until the mtime of
+    the directory changes, so that repeated Tab presses on big
+    (or remote) directories do not list them again.
+    """
+    def __init__(self):
+        self.cache = dict() # directory -> (mtime, [(name, is_dir)])
+
+    def _listdir(self, path):
+        if scandir:
+            return [(d.name, d.is_dir()) for d in scandir(path)]
+        return [(n, os.path.isdir(os.path.join(path, n)))
+                for n in os.listdir(path)]
+
+    def listdir(self, path):
+        """
+        Returns the (cached) [(name, is_dir)] of directory path
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+            cached = self.cache.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, self._listdir(path))
+                self.cache[path] = cached
+        except OSError:
+            return []
+        return cached[1]
+
+    def _rank(self, item):
+        name, is_dir = item
+        if name.endswith('.kdb'):
+            return (0, name)
+        return (1 if is_dir else 2, name)
 
-logging.basicConfig()
+    def complete(self, token):
+        """
+        Returns the completions of token (a partial path that
+        can contain ~ and environment variables). .kdb files
+        come first, then directories
+        """
+        if '/' in token:
+            parent, name = token.rsplit('/', 1)
+            parent += '/'
+        else:
+            parent, name = '', token
+        path = os.path.expanduser(os.path.expandvars(parent)) or '.'
+        matches = [i for i in self.listdir(path) if i[0].startswith(name)
+                   and (name.startswith('.') or not i[0].startswith('.'))]
+        matches.sort(key=self._rank)
+        return [parent + n + ('/' if is_dir else '') for n, is_dir in matches]
+
+class CompletionIndex(object):
+    """
+    Sorted lists of the lowercased child titles of every group,
+    so that completions are found by bisection instead of
+    scanning (and lowercasing) the whole group on every Tab.
+
+    Built once when the DB is opened and kept up to date
+    by the shell commands like EntryIndex.
+    """
+    def __init__(self):
+        self.groups = dict()  # group -> sorted [(lowercased, title)]
+        self.entries = dict() # group -> sorted [(lowercased, title)]
+        self.keys = dict()    # item -> (list, key) it was added with
+
+    def build(self, db):
+        for g in db.groups:
+            self.add(g)
+        for e in db.entries:
+            self.add(e)
+
+    def add(self, item):
+        """
+        Add (or re-add) a group or entry
+        """
+        self._unlink(item)
+        title = item.title or u''
+        if hasattr(item, 'children'):
+            l = self.groups.setdefault(item.parent, [])
+        else:
+            l = self.entries.setdefault(item.group, [])
+        key = (title.lower(), title)
+        bisect.insort(l, key)
+        self.keys[item] = (l, key)
+
+    def _unlink(self, item):
+        l, key = self.keys.pop(item, (None, None))
+        if l is None:
+            return
+        i = bisect.bisect_left(l, key)
+        if i < len(l) and l[i] == key:
+            del l[i]
 
-class PkpCli(cmd.Cmd):
+    def remove(self, item):
+        """
+        Remove a group or entry using the title it was added
+        with (and the children lists of a group)
+        """
+        self._unlink(item)
+        self.groups.pop(item, None)
+        self.entries.pop(item, None)
+
+    def _range(self, l, prefix):
+        i = bisect.bisect_left(l, (prefix,))
+        while i < len(l) and l[i][0].startswith(prefix):
+            yield l[i][1]
+            i += 1
+
+    def complete(self, group, prefix, entries=True):
+        """
+        Titles of the children of group starting with prefix
+        (case insensitive); groups end with a slash
+        """
+        prefix = prefix.lower()
+        result = [t + '/' for t in self._range(self.groups.get(group, []), prefix)]
+        if entries:
+            result.extend(self._range(self.entries.get(group, []), prefix))
+        return result
+
+class PasswordGenerator(object):
+    """
+    Passwords and passphrases drawn from os.urandom.
+
+    Every choice is rejection sampled, so all the characters
+    (or words) are equally likely, and passwords missing one
+    of the requested character classes are drawn again, so the
+    result is uniform over the passwords covering all of them.
+    """
+    CLASSES = {
+        'l': 'abcdefghijklmnopqrstuvwxyz',
+        'u': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+        'd': '0123456789',
+        's': '!@#$%^&*()',
+        'p': '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~',
+    }
+    WORDLISTS = ('/usr/share/dict/words', '/usr/dict/words')
+
+    def __init__(self):
+        self.pool = ''
+        self.words = dict() # wordlist file -> words
+
+    def _bytes(self, n):
+        # read urandom in chunks, bulk generation needs a lot of it
+        if len(self.pool) < n:
+            self.pool += os.urandom(max(4096, n))
+        b, self.pool = self.pool[:n], self.pool[n:]
+        return b
+
+    def randbelow(self, n):
+        """
+        Uniform random integer in [0, n)
+        """
+        size = 1
+        while 256 ** size < n:
+            size += 1
+        limit = 256 ** size - 256 ** size % n
+        while True:
+            r = int(self._bytes(size).encode('hex'), 16)
+            if r < limit:
+                return r % n
+
+    def password(self, length=8, classes='lud'):
+        """
+        Returns a password of length characters with at least
+        one of each of the classes (see CLASSES)
+        """
+        sets = [self.CLASSES[c] for c in classes]
+        if length < len(sets):
+            raise ValueError('%d characters cannot cover %d classes' % (length, len(sets)))
+        alphabet = ''.join(sorted(set(''.join(sets))))
+        while True:
+            pw = ''.join(alphabet[self.randbelow(len(alphabet))]
+                         for i in xrange(length))
+            if all(any(c in s for c in pw) for s in sets):
+                return pw
+
+    def wordlist(self, path=None):
+        """
+        Returns the lowercase words (3 to 9 letters) of path
+        or of the first system wordlist found
+        """
+        paths = [path] if path else [p for p in self.WORDLISTS if os.path.isfile(p)]
+        if not paths:
+            raise ValueError('no wordlist found')
+        path = paths[0]
+        if path not in self.words:
+            with open(path) as fp:
+                words = set(w.strip() for w in fp)
+            self.words[path] = sorted(w for w in words
+                                      if w.isalpha() and w.islower() and 3 <= len(w) <= 9)
+        if not self.words[path]:
+            raise ValueError('no usable words in %s' % path)
+        return self.words[path]
+
+    def passphrase(self, words=5, wordlist=None, separator='-'):
+        """
+        Returns words random words of wordlist
+        """
+        l = self.wordlist(wordlist)
+        return separator.join(l[self.randbelow(len(l))] for i in xrange(words))
+
+COMMON_PASSWORDS = frozenset([
+    '123456', '12345678', '123456789', '1234567890', '111111', '000000',
+    'password', 'password1', 'passw0rd', 'qwerty', 'qwertyuiop', 'abc123',
+    'letmein', 'welcome', 'admin', 'root', 'toor', 'changeme', 'secret',
+    'iloveyou', 'monkey', 'dragon', 'master', 'login', 'football'])
+
+def password_strength(password):
+    """
+    Estimated strength (bits) of password: its length times the
+    bits of the alphabet of the character classes it uses, where
+    repeated and sequential characters (aaa, abc, 321) count a
+    quarter; 0 for the common passwords.
+    Module level, so that audit can run it in a process pool
+    """
+    if not password or password.lower() in COMMON_PASSWORDS:
+        return 0.0
+    sizes = {'l': 26, 'u': 26, 'd': 10, 'p': 33, 'x': 100}
+    used = set()
+    length = 0.0
+    prev = None
+    for c in password:
+        if 'a' <= c <= 'z':
+            used.add('l')
+        elif 'A' <= c <= 'Z':
+            used.add('u')
+        elif '0' <= c <= '9':
+            used.add('d')
+        elif ord(c) < 128:
+            used.add('p')
+        else:
+            used.add('x')
+        o = ord(c)
+        length += 0.25 if prev is not None and abs(o - prev) <= 1 else 1
+        prev = o
+    return round(length * math.log(sum(sizes[k] for k in used), 2), 1)
+
+class Clipboard(object):
+    """
+    The system clipboard, through pyperclip or the first of
+    COMMANDS found, detected once on the first copy.
+
+    With a timeout, what is copied is cleared that many seconds
+    later by a timer thread, unless something else has been
+    copied in the meantime (then it is left alone).
+    """
+    # name, copy command, paste command, variable of the display
+    COMMANDS = (
+        ('wl-copy', ['wl-copy'], ['wl-paste', '-n'], 'WAYLAND_DISPLAY'),
+        ('xclip', ['xclip', '-selection', 'clipboard'],
+         ['xclip', '-selection', 'clipboard', '-o'], 'DISPLAY'),
+        ('xsel', ['xsel', '-b', '-i'], ['xsel', '-b', '-o'], 'DISPLAY'),
+        ('pbcopy', ['pbcopy'], ['pbpaste'], None),
+    )
+
+    def __init__(self, timeout=0):
+        self.timeout = timeout
+        self.backend = None # (name, copy(text), paste()), False if none
+        self.timer = None
+        self.lock = None
+        self.copied = None  # digest of the text to clear
+
+    def _which(self, program):
+        for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            if os.access(os.path.join(d, program), os.X_OK):
+                return True
+        return False
+
+    def _commands(self, copy, paste):
+        import subprocess
+
+        def copy_text(text):
+            with open(os.devnull, 'w') as null:
+                # xclip stays in background owning the selection:
+                # its output must not be a pipe we wait on
+                p = subprocess.Popen(copy, stdin=subprocess.PIPE,
+                                     stdout=null, stderr=null)
+                p.communicate(text.encode('utf-8'))
+            if p.returncode:
+                raise EnvironmentError('%s exited with status %d' % (copy[0], p.returncode))
+
+        def paste_text():
+            with open(os.devnull, 'w') as null:
+                return subprocess.check_output(paste, stderr=null).decode('utf-8')
+        return copy_text, paste_text
+
+    def _detect(self):
+        try:
+            import pyperclip
+            return 'pyperclip', pyperclip.copy, pyperclip.paste
+        except ImportError:
+            pass
+        for name, copy, paste, display in self.COMMANDS:
+            if (display is None or os.environ.get(display)) and self._which(copy[0]):
+                return (name,) + self._commands(copy, paste)
+        return False
+
+    def copy(self, text):
+        """
+        Copies text into the clipboard (to be cleared
+        after timeout seconds)
+        """
+        import hashlib
+        import threading
+
+        if self.backend is None:
+            self.backend = self._detect()
+        if not self.backend:
+            raise EnvironmentError('no clipboard found, install pyperclip '
+                                   '(or xclip, xsel, wl-clipboard)')
+        if self.lock is None:
+            self.lock = threading.Lock()
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.backend[1](text)
+            if not self.timeout:
+                return
+            self.copied = hashlib.sha256(text.encode('utf-8')).digest()
+            self.timer = threading.Timer(self.timeout, self.clear, [self.copied])
+            self.timer.daemon = True
+            self.timer.start()
+
+    def clear(self, digest):
+        """
+        Clears the clipboard if it still holds the text
+        copied with digest (see copy())
+        """
+        import hashlib
+
+        with self.lock:
+            if self.copied != digest:
+                return # copied again in the meantime
+            self.copied = self.timer = None
+            name, copy, paste = self.backend
+            try:
+                current = paste()
+                if current is None or hashlib.sha256(current.encode('utf-8')).digest() == digest:
+                    copy(u'')
+            except Exception:
+                pass # in the timer thread: nobody to tell
+
+    def flush(self):
+        """
+        Clears now what would be cleared later (on exit)
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.clear(self.copied)
+
+class Stats(object):
+    """
+    Call counts and latency histograms of the instrumented
+    operations: the commands (cmd.NAME), the phases of open
+    and save, and the DB layer (db.*: key transformation,
+    crypto, parsing and disk writes)
+    """
+    BUCKETS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000) # ms
+
+    def __init__(self):
+        self.ops = dict() # name -> [count, total, min, max, histogram]
+
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        op = self.ops.get(name)
+        if op is None:
+            op = self.ops[name] = [0, 0.0, ms, ms, [0] * (len(self.BUCKETS) + 1)]
+        op[0] += 1
+        op[1] += ms
+        op[2] = min(op[2], ms)
+        op[3] = max(op[3], ms)
+        op[4][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def percentile(self, name, p):
+        """
+        Upper bound of the bucket holding the p-th percentile
+        of name (the maximum for the last bucket)
+        """
+        count, total, low, high, histogram = self.ops[name]
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if seen >= count * p / 100.0:
+                return min(self.BUCKETS[i], high) if i < len(self.BUCKETS) else high
+        return high
+
+    def to_dict(self):
+        labels = ['<=%g' % b for b in self.BUCKETS] + ['>%g' % self.BUCKETS[-1]]
+        d = dict()
+        for name, (count, total, low, high, histogram) in self.ops.items():
+            d[name] = dict(count=count, total_ms=round(total, 3),
+                           mean_ms=round(total / count, 3),
+                           min_ms=round(low, 3), max_ms=round(high, 3),
+                           p50_ms=round(self.percentile(name, 50), 3),
+                           p95_ms=round(self.percentile(name, 95), 3),
+                           histogram_ms=dict((l, n) for l, n in zip(labels, histogram) if n))
+        return d
+
+    def report(self):
+        """
+        Returns the lines of the stats table, slowest total first
+        """
+        lines = ['%-24s %7s %10s %9s %9s %9s %9s' % (
+            'operation', 'calls', 'total ms', 'mean ms', 'p50 <=', 'p95 <=', 'max ms')]
+        for name, op in sorted(self.ops.items(), key=lambda i: -i[1][1]):
+            count, total, low, high, histogram = op
+            lines.append('%-24s %7d %10.1f %9.3f %9.3f %9.3f %9.3f' % (
+                name, count, total, total / count, self.percentile(name, 50),
+                self.percentile(name, 95), high))
+        return lines
+
+    def histogram(self, name):
+        """
+        Returns the lines of the histogram of name
+        """
+        count, total, low, high, histogram = self.ops[name]
+        labels = ['<= %g ms' % b for b in self.BUCKETS] + ['> %g ms' % self.BUCKETS[-1]]
+        top = max(histogram)
+        return ['%12s %7d %s' % (l, n, '#' * int(round(40.0 * n / top)))
+                for l, n in zip(labels, histogram) if n]
+
+class Vault(object):
+    """
+    An opened DB and the state of the shell on it (cwd,
+    write-back counters, indexes and caches). The shell works
+    on the current vault through the properties of PkpCli
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.last_used = time.time()
+        self.file_stat = None # of the file when it was read
+        self.db = None
+        self.cwd = None
+        self.need_save = None
+        self.pending_changes = 0
+        self.dirty_since = None
+        self.index = None
+        self.completion = None
+        self._generations = dict()
+        self._children_cache = dict()
+        self._path_cache = dict()  # normalized path -> group
+        self._group_paths = dict() # group -> path
+
+def _vault_property(name):
+    return property(lambda self: getattr(self.vault, name),
+                    lambda self, value: setattr(self.vault, name, value))
+
+class PkpCli(cmd.Cmd, object):
     """
     Pkpcli is a simple shell-like software to keepass DB files.
     It uses extensively the keepassdb module by Hans Lellelid
@@ -30,22 +984,68 @@ class PkpCli(cmd.Cmd):
     in the future this should be splitted into some other helper
     classes/modules.
     """
-    def __init__(self, db_path=None, db_key=None):
+    # the state of the current vault (see Vault); these
+    # properties need a new-style class, cmd.Cmd is not
+    db = _vault_property('db')
+    cwd = _vault_property('cwd')
+    need_save = _vault_property('need_save')
+    pending_changes = _vault_property('pending_changes')
+    dirty_since = _vault_property('dirty_since')
+    index = _vault_property('index')
+    completion = _vault_property('completion')
+    _generations = _vault_property('_generations')
+    _children_cache = _vault_property('_children_cache')
+    _path_cache = _vault_property('_path_cache')
+    _group_paths = _vault_property('_group_paths')
+
+    VAULT_PREFIX = re.compile(r'(?<!\S)([\w.-]+):')
+
+    def __init__(self, db_path=None, db_key=None, batch=False,
+                 save_every=0, save_interval=0, key_cache=None,
+                 readonly=False, lock_timeout=0, journal=False,
+                 max_vaults=8, vault_idle=0, stats=None, clip_timeout=0):
         cmd.Cmd.__init__(self)
 
         self.db_path = db_path
         self.db_key = db_key
-        self.db = None
-        self.need_save = None
+        self.batch = batch
+        self.key_cache = key_cache
+        # a writer waits lock_timeout seconds for the lock
+        # held by another session, readers never take it
+        self.readonly = readonly
+        self.lock_timeout = lock_timeout
+        # every change is also appended to FILE.journal, so
+        # that unsaved changes survive a crash
+        self.use_journal = journal
+
+        # the opened DBs, least recently used first: beyond
+        # max_vaults, or when unused for vault_idle seconds,
+        # they are saved and closed (the current one excepted)
+        self.vaults = OrderedDict()
+        self.vault = Vault(None, None)
+        self.max_vaults = max_vaults
+        self.vault_idle = vault_idle
+        self.closed_vaults = dict() # name -> path, reopened on use
+
+        # write-back policy: unsaved changes are coalesced and
+        # flushed after save_every changes or save_interval
+        # seconds (0 means never; both checked after each
+        # command), on save and on close
+        self.save_every = save_every
+        self.save_interval = save_interval
+
+        self.files = FileCompleter()
+        self.passwords = PasswordGenerator()
+        # copied fields are cleared after clip_timeout seconds
+        self.clipboard = Clipboard(clip_timeout)
+        self.stats = stats or Stats()
 
         self.intro = 'Simple KeePass db shell'
         self.ruler = '-'
 
         if self.db_path:
-            self.db = self._open_db(db_path,db_key)
-            
-        keepassdb.model.RootGroup.title = '/'
-        
+            self._open_db(db_path,db_key,readonly=readonly)
+
         self._set_prompt()
 
     def db_opened(f):
@@ -62,24 +1062,45 @@ class PkpCli(cmd.Cmd):
                 return False
         return wrapper
 
-    def _open_db(self, path, key=None, password=None):
+    def db_writable(f):
         """
-        Returns db object
+        Same as db_opened, but the DB must also
+        be opened read-write
         """
-        if self.db:
-            print "DB already opened!"
-            print "Please close it first"
-            return self.db
-        
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if not self.db:
+                print "Database file not opened!"
+                return False
+            if self.db.readonly:
+                print "Database opened read-only!"
+                return False
+            return f(self, *args, **kwargs)
+        return wrapper
+
+    def _open_db(self, path, key=None, password=None, readonly=False, keep=()):
+        """
+        Opens path in a new vault, that becomes the current
+        one (the vaults in keep are not evicted to make room
+        for it). Returns db object
+        """
+        for v in self.vaults.values():
+            if v.path == os.path.realpath(path):
+                print "DB already opened as %s:" % v.name
+                self._use(v)
+                return v.db
+
         if os.path.isfile(path):
             is_new = None
+        elif readonly:
+            print "Cannot open db %s: no such file" % path
+            return
         else:
             print 'Creating new KeePass DB: %s' % path
             is_new = True
-            self.need_save = True
 
             # is there a better way?
-            p1,p2 = ('','.')
+            p1,p2 = (password,password) if password else ('','.')
             while p1 != p2:
                 p1 = getpass.getpass("Insert password for new DB %s: " % path)
                 p2 = getpass.getpass('Repeat password: ')
@@ -91,38 +1112,268 @@ class PkpCli(cmd.Cmd):
         if not password:
             password = getpass.getpass("Insert DB password for %s: " % path)
             
+        import pkpdb
+        file_stat = self._file_stat(path)
         try:
-            db = LockingDatabase(path, password=password, new=is_new)
+            with self.stats.timer('open.load'):
+                db = pkpdb.PkpDatabase(path, password=password, new=is_new,
+                                       key_cache=self.key_cache, readonly=readonly,
+                                       lock_timeout=self.lock_timeout, stats=self.stats)
             self.password = password
-        except keepassdb.exc.DatabaseAlreadyLocked, e:
-            print "The database is already in use or have a stale lock file"
-            if self._confirm(message='Do you want to remove it (y/N)? ',
-                             default=False):
-                lock_file = "{}.lock".format(path)
-                os.remove(lock_file)
-                print "Lock %s removed" % lock_file
-                print "Please re-launch this program"
-                sys.exit(1)
+        except pkpdb.exc.DatabaseAlreadyLocked, e:
+            owner = pkpdb.lock_owner("{}.lock".format(path))
+            if owner:
+                print "The database is in use by pid %d on %s since %s" % (
+                    owner[0], owner[1], time.ctime(owner[2]))
             else:
+                print "The database is in use by another program"
+            if self.batch:
                 print 'Exiting...'
-                sys.exit(0)
-        except keepassdb.exc.AuthenticationError, e:
+                sys.exit(1)
+            if self._confirm(message='Do you want to open it read-only (Y/n)? ',
+                             default=True):
+                return self._open_db(path, key, password, readonly=True, keep=keep)
+            return
+        except pkpdb.exc.AuthenticationError, e:
             print 'Hash sum mismatch: maybe wrong key/password?'
             return
         except Exception, e:
             print "Cannot open db %s: %s" % (path, e)
-            lock_file = "{}.lock".format(path)
-            os.remove(lock_file)
-            sys.exit(1)
+            return
             
         if is_new:
             print 'Creating default groups...'
             db.create_default_group()
+            # saved right away: the journal needs the key of the file
+            try:
+                db.save(password=password)
+            except Exception, e:
+                print "Cannot create db %s: %s" % (path, e)
+                db.close()
+                return
             
-        print "Working with DB file %s " % path
+        print "Working with DB file %s%s" % (path, ' (read-only)' if readonly else ' ')
+        self._use(Vault(self._vault_name(path), os.path.realpath(path)))
+        self.vault.file_stat = file_stat
         self.cwd = db.root
+        with self.stats.timer('open.index'):
+            self.index = EntryIndex()
+            self.index.defer(db)
+            self.completion = CompletionIndex()
+            self.completion.build(db)
+        self.db = db
+        self.need_save = None
+        with self.stats.timer('open.journal'):
+            self._open_journal()
+        self.closed_vaults.pop(self.vault.name, None)
+        self._evict(keep)
         return db
 
+    def _file_stat(self, path):
+        """
+        Returns what changes when path is saved (inode, mtime
+        and size), None if it does not exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _reload(self, path):
+        """
+        Opens path (read-only) again if it was saved since it was
+        read, or if it could not be opened; see serve()
+        """
+        if self.db and self.vault.file_stat == self._file_stat(path):
+            return
+        if self.db:
+            self._close_db()
+        self._open_db(path, password=self.password, readonly=True)
+
+    def _vault_name(self, path):
+        """
+        Returns an unused vault name for the DB file path
+        (its name without extension)
+        """
+        base = re.sub(r'[^\w.-]', '_', os.path.splitext(os.path.basename(path))[0]) or 'db'
+        name, n = base, 1
+        while name in self.vaults:
+            n += 1
+            name = '%s-%d' % (base, n)
+        return name
+
+    def _use(self, vault):
+        """
+        Makes vault the current (and most recently used) one
+        """
+        self.vaults.pop(vault.name, None)
+        self.vaults[vault.name] = vault
+        vault.last_used = time.time()
+        self.vault = vault
+
+    @contextmanager
+    def _using(self, vault):
+        """
+        Runs the block with vault as the current one
+        """
+        current = self.vault
+        self.vault = vault
+        vault.last_used = time.time()
+        try:
+            yield vault
+        finally:
+            # never back to a vault closed meanwhile
+            if current.name is None or self.vaults.get(current.name) is current:
+                self.vault = current
+            else:
+                self.vault = self.vaults.values()[-1] if self.vaults else Vault(None, None)
+
+    def _get_vault(self, name):
+        """
+        Returns the opened vault name, reopening it if it
+        was evicted; None if unknown
+        """
+        if name in self.vaults:
+            return self.vaults[name]
+        path = self.closed_vaults.get(name)
+        if path is None:
+            return None
+        current = self.vault
+        print 'Reopening %s:' % name
+        # the current vault is switched back to: keep it opened
+        if self._open_db(path, keep=(current,)) is None:
+            return None
+        vault = self.vault
+        if self.vaults.get(current.name) is current:
+            self._use(current)
+        return vault
+
+    def _evict(self, keep=()):
+        """
+        Closes the least recently used vaults beyond
+        max_vaults and the ones idle for vault_idle seconds
+        (except the current one and the ones in keep)
+        """
+        now = time.time()
+        for v in self.vaults.values():
+            if v is self.vault or v in keep:
+                continue
+            if ((self.max_vaults and len(self.vaults) > self.max_vaults) or
+                (self.vault_idle and now - v.last_used >= self.vault_idle)):
+                print 'Closing unused %s:' % v.name
+                with self._using(v):
+                    if self.need_save:
+                        self.do_save()
+                    self._close_db()
+                self.closed_vaults[v.name] = v.path
+
+    def _open_journal(self):
+        """
+        Replays the changes left in the journal by a session
+        that did not save them, then (unless read-only) keeps
+        journaling the changes of this session
+        """
+        import pkpdb
+        journal = pkpdb.Journal(self.db.filepath + '.journal', self.db.final_key)
+        records = journal.read()
+        if journal.stale:
+            print 'Ignoring %s: it does not match the database' % journal.path
+        if records:
+            print 'Replaying %d unsaved changes from %s' % (len(records), journal.path)
+            self._replay(records)
+        if self.db.readonly:
+            return
+        journal.truncate()
+        if self.use_journal or records:
+            self.db.journal = journal
+
+    def _replay(self, records):
+        """
+        Applies the journal records (see _journal()) to the DB
+        (a read-only DB is not marked as changed)
+        """
+        groups = {g.id: g for g in self.db.groups}
+        groups[None] = self.db.root
+        entries = {e.uuid: e for e in self.db.entries}
+        for n, r in enumerate(records):
+            try:
+                op = r['op']
+                if op == 'mkdir':
+                    parent = groups[r['parent']]
+                    p = None if parent is self.db.root else parent
+                    g = self.db.create_group(parent=p, title=r['title'])
+                    g.id = r['id']
+                    groups[g.id] = g
+                    self._group_added(g)
+                elif op == 'rmdir':
+                    items = self._subtree(groups[r['id']])
+                    self.db.remove_group(group=items[0])
+                    self._group_removed(items)
+                    if self.cwd in items:
+                        self.cwd = self.db.root
+                elif op == 'new':
+                    group = groups[r['group']]
+                    e = self.db.create_entry(group=group)
+                    e.group = group
+                    self._set_entry_record(e, r)
+                    entries[e.uuid] = e
+                    self._entry_added(e)
+                elif op == 'edit':
+                    e = entries[r['uuid']]
+                    self._set_entry_record(e, r)
+                    self._entry_changed(e)
+                elif op == 'rm':
+                    e = entries.pop(r['uuid'])
+                    self.db.remove_entry(entry=e)
+                    self._entry_removed(e)
+                elif op in ('move', 'movedir'):
+                    if op == 'move':
+                        item = entries[r['uuid']]
+                    else:
+                        item = groups[r['id']]
+                    self._move_item(item, groups[r['group' if op == 'move' else 'parent']],
+                                    r['title'])
+            except (KeyError, ValueError), e:
+                print 'Cannot replay change %d (%s): %s' % (n + 1, r.get('op'), e)
+                continue
+            # read-only: replayed in memory only, nothing to save
+            if not self.db.readonly:
+                self._mark_dirty()
+
+    def _entry_record(self, entry):
+        """
+        Returns the fields of entry for the journal
+        """
+        d = dict(uuid=entry.uuid)
+        for f in self.ENTRY_FIELDS:
+            value = getattr(entry, f)
+            if hasattr(value, 'strftime'):
+                value = value.strftime(self.JOURNAL_TIME)
+            d[f] = value
+        return d
+
+    def _set_entry_record(self, entry, record):
+        """
+        Sets the fields of entry from a journal record
+        """
+        import datetime
+        entry.uuid = record['uuid']
+        for f in self.ENTRY_FIELDS:
+            value = record[f]
+            if f in ('created', 'modified', 'accessed', 'expires') and value:
+                value = datetime.datetime.strptime(value, self.JOURNAL_TIME)
+            setattr(entry, f, value)
+
+    def _journal(self, op, **record):
+        """
+        Appends a change to the journal, if any. The records are
+        synced to disk by _flush(), once per command
+        """
+        if self.db.journal:
+            record['op'] = op
+            self.db.journal.append(record)
+
     def _close_db(self):
         """
         Helper function to close the DB
@@ -130,17 +1381,55 @@ class PkpCli(cmd.Cmd):
         if not self.db:
             return
         
+        vault = self.vault
         try:
             print "Closing db %s" % self.db.filepath
-            if self.need_save:
+            if self.need_save and not self.db.readonly:
                 if self._confirm(message="Database not saved! \nDo you want to save it now? (Y/n): ",default=True):
                     self.do_save()
+                elif self.db.journal:
+                    self.db.journal.discard()
             self.db.close()
         except Exception, e:
             print "Cannot close db %s: %s" % (self.db.filepath, e)
         finally:
-            self.cwd = None
-            self.db = None
+            self.vaults.pop(vault.name, None)
+            self.vault = self.vaults.values()[-1] if self.vaults else Vault(None, None)
+
+    def _close_all(self):
+        """
+        Closes all the vaults
+        """
+        while self.vaults:
+            self.vault = self.vaults.values()[-1]
+            self._close_db()
+
+    def _mark_dirty(self):
+        """
+        Records an unsaved change. The DB is actually written
+        by _flush() according to the write-back policy
+        """
+        self.need_save = True
+        self.pending_changes += 1
+        if self.dirty_since is None:
+            self.dirty_since = time.time()
+
+    def _flush(self):
+        """
+        Saves the DBs if the write-back policy says so
+        (the journals, if any, are synced anyway)
+        """
+        for v in self.vaults.values():
+            if not v.pending_changes:
+                continue
+            with self._using(v):
+                if self.db.journal:
+                    self.db.journal.sync()
+                if self.save_every and self.pending_changes >= self.save_every:
+                    self.do_save()
+                elif (self.save_interval and
+                      time.time() - self.dirty_since >= self.save_interval):
+                    self.do_save()
 
     def _set_prompt(self):
         """
@@ -151,7 +1440,9 @@ class PkpCli(cmd.Cmd):
             self.prompt = '>> '
             return
         else:
-            self.prompt = "{}> ".format(self.cwd.title)
+            self.prompt = "{}{}{}> ".format(
+                self.vault.name + ':' if len(self.vaults) > 1 else '',
+                self._group_path(self.cwd), ' (ro)' if self.db.readonly else '')
         return
 
     def _current_childrens(self, what=None):
@@ -159,30 +1450,212 @@ class PkpCli(cmd.Cmd):
         Returns a dict containing entries and group from
         self.cwd that can be used by all other functions 
         """
-        d = dict()
-        # orrible
-        # convert into generators
-        d_entries = {e.title: e for e in self.cwd.entries}
-        d_groups = {g.title: g for g in self.cwd.children}
-        if what == 'entries':
-            return d_entries
-        elif what == 'groups':
-            return d_groups
-        else:
-            d['entries'] = d_entries
-            d['groups'] = d_groups
-            
+        return self._childrens(self.cwd, what)
+
+    def _childrens(self, group, what=None):
+        """
+        Returns the (cached) title -> object maps of group.
+        The maps are rebuilt only when the generation of the
+        group has been bumped by _touch(), so they must
+        be treated as read-only by the callers
+        """
+        gen = self._generations.get(group, 0)
+        cached = self._children_cache.get(group)
+        if cached is None or cached[0] != gen:
+            d = dict()
+            d['entries'] = {e.title: e for e in group.entries}
+            d['groups'] = {g.title: g for g in group.children}
+            cached = (gen, d)
+            self._children_cache[group] = cached
+        d = cached[1]
+        if what:
+            return d[what]
         return d
 
+    def _touch(self, group):
+        """
+        Bumps the generation of group, invalidating its
+        cached children maps
+        """
+        self._generations[group] = self._generations.get(group, 0) + 1
+
+    def _group_path(self, group):
+        """
+        Returns the full "path" of a group, built from
+        the (cached) path of its parent
+        """
+        path = self._group_paths.get(group)
+        if path is None:
+            if group.parent is None:
+                path = '/'
+            else:
+                path = "{}/{}".format(
+                    self._group_path(group.parent).rstrip('/'), group.title)
+            self._group_paths[group] = path
+        return path
+
+    def _item_path(self, item):
+        """
+        Returns the full "path" of an entry or a group
+        (groups end with a slash)
+        """
+        if hasattr(item, 'children'):
+            return self._group_path(item).rstrip('/') + '/'
+        return "{}/{}".format(self._group_path(item.group).rstrip('/'),
+                              item.title)
+
+    def _walk(self, group):
+        """
+        Generator of group and all the groups below it (depth first)
+        """
+        stack = [group]
+        while stack:
+            g = stack.pop()
+            yield g
+            stack.extend(reversed(g.children))
+
+    def _subtree(self, group):
+        """
+        Returns the groups and entries below group (included)
+        """
+        items = list(self._walk(group))
+        entries = [e for g in items for e in g.entries]
+        return items + entries
+
+    def _normpath(self, path):
+        """
+        Returns the absolute, normalized form of path
+        (relative paths start from cwd, . and .. are resolved)
+        """
+        if path.startswith('/'):
+            titles = []
+        else:
+            titles = [t for t in self._group_path(self.cwd).split('/') if t]
+        for t in path.split('/'):
+            if t in ('', '.'):
+                continue
+            if t == '..':
+                if titles:
+                    titles.pop()
+            else:
+                titles.append(t)
+        return '/' + '/'.join(titles)
+
+    def _group_for_path(self, path, create=False):
+        """
+        Returns the group at path (absolute or relative to cwd),
+        or None if not found. With create the missing groups
+        are created on the way
+        """
+        path = self._normpath(path)
+        group = self._path_cache.get(path)
+        if group is not None:
+            return group
+        group = self.db.root
+        for title in [t for t in path.split('/') if t]:
+            child = self._childrens(group, 'groups').get(title)
+            if child is None:
+                if not create:
+                    return None
+                p = None if group is self.db.root else group
+                child = self.db.create_group(parent=p, title=title)
+                self._group_added(child)
+            group = child
+        self._path_cache[path] = group
+        return group
+
+    def _split_path(self, path):
+        """
+        Splits an entry path in (group, title); group is None
+        if the parent path does not exist
+        """
+        if '/' not in path:
+            return self.cwd, path
+        parent, title = path.rsplit('/', 1)
+        return self._group_for_path(parent or '/'), title
+
+    def _entry_for_path(self, path):
+        """
+        Returns the entry at path (absolute or relative to cwd),
+        or None if not found
+        """
+        group, title = self._split_path(path)
+        if group is None:
+            return None
+        return self._childrens(group, 'entries').get(title)
+
+    # The following hooks are called by every command that changes
+    # the tree, to keep the helper structures (and the journal)
+    # up to date.
+    def _entry_added(self, entry):
+        self._touch(entry.group)
+        self.index.add(entry)
+        self.completion.add(entry)
+        self._journal('new', group=entry.group.id, **self._entry_record(entry))
+
+    def _entry_changed(self, entry, reindex=True):
+        # reindex=False when only the (not indexed) password changed
+        self._touch(entry.group)
+        if reindex:
+            self.index.add(entry)
+            self.completion.add(entry)
+        self._journal('edit', **self._entry_record(entry))
+
+    def _entry_removed(self, entry):
+        self._touch(entry.group)
+        self.index.remove(entry)
+        self.completion.remove(entry)
+        self._journal('rm', uuid=entry.uuid)
+
+    def _group_added(self, group):
+        self._touch(group.parent)
+        self._path_cache.clear()
+        self._group_paths.clear()
+        self.index.add(group)
+        self.completion.add(group)
+        parent = None if group.parent is self.db.root else group.parent.id
+        self._journal('mkdir', id=group.id, parent=parent, title=group.title)
+
+    def _group_removed(self, items):
+        """
+        items are the groups and entries that were
+        below the removed group (see _subtree())
+        """
+        self._touch(items[0].parent)
+        self._path_cache.clear()
+        self._group_paths.clear()
+        for i in items:
+            self.index.remove(i)
+            self.completion.remove(i)
+            self._generations.pop(i, None)
+            self._children_cache.pop(i, None)
+        self._journal('rmdir', id=items[0].id)
+
+    def _entry_moved(self, entry, old_group):
+        self._touch(old_group)
+        self._touch(entry.group)
+        self.index.add(entry)
+        self.completion.add(entry)
+        self._journal('move', uuid=entry.uuid, group=entry.group.id,
+                      title=entry.title)
+
+    def _group_moved(self, group, old_parent):
+        self._touch(old_parent)
+        self._touch(group.parent)
+        self._path_cache.clear()
+        self._group_paths.clear()
+        self.index.add(group)
+        self.completion.add(group)
+        parent = None if group.parent is self.db.root else group.parent.id
+        self._journal('movedir', id=group.id, parent=parent, title=group.title)
+
     def _show_entry(self, complete=None, entry_name=None):
         '''
         Helper function to show an entry.
         Serves do_show() and do_showall()
         '''
-        l = self._current_childrens('entries')            
-        if entry_name in l.keys():
-            e = l[entry_name]
-        else:
+        e = self._entry_for_path(entry_name)
+        if e is None:
             print 'Nothing to show...'
             return
         
@@ -198,7 +1671,7 @@ class PkpCli(cmd.Cmd):
  Expires on: {expires}
  
  '''.format(title=e.title,
-            group=e.group.title,
+            group=self._group_path(e.group).rstrip('/'),
             username=e.username,
             url=e.url,
             password=password,
@@ -219,8 +1692,11 @@ class PkpCli(cmd.Cmd):
     def _confirm(self, message=None, default=False):
         '''
         Simple way to confirm question.
-        Returns boolean
+        Returns boolean (always True in batch mode)
         '''
+        if self.batch:
+            print '%sy' % message
+            return True
         a = raw_input(message)
         if a == '':
             return default
@@ -230,90 +1706,96 @@ class PkpCli(cmd.Cmd):
             return False
         
 
+    def _complete_path(self, text, line, endidx, entries=True):
+        '''
+        Completes the path under the cursor (absolute or relative).
+        readline may split the path on /, so the completions
+        returned only replace the text it passed
+        '''
+        if not self.db:
+            return []
+        token = line[line.rfind(' ', 0, endidx) + 1:endidx]
+        if '/' in token:
+            parent, name = token.rsplit('/', 1)
+            group = self._group_for_path(parent or '/')
+            parent += '/'
+        else:
+            parent, name, group = '', token, self.cwd
+        if group is None:
+            return []
+        head = len(token) - len(text)
+        return [(parent + t)[head:] for t in
+                self.completion.complete(group, name, entries)]
+
     def _complete_entries(self, text, line, begidx, endidx):
         '''
-        Still incomplete function to serve all completion
+        Completes entries (and the groups in their path)
         '''
-        return [e.title for e in self.cwd.entries if
-                e.title.lower().startswith(text.lower())]
+        return self._complete_path(text, line, endidx, entries=True)
 
     def _complete_groups(self, text, line, begidx, endidx):
         '''
-        Still incomplete function to serve all completion
+        Completes groups only
         '''
-        return [g.title for g in self.cwd.children if
-                g.title.lower().startswith(text.lower())]
+        return self._complete_path(text, line, endidx, entries=False)
 
     def _attr_copy(self, what=None, entry_name=None):
         '''
-        Copies username/password/other into clipboard
+        Copies a field (see ENTRY_FIELDS) of an entry into clipboard
         '''
-        try:
-            import pyperclip
-        except ImportError:
-            print 'You need to install the pyperclip module to use this!'
-            return
-
-        l = self._current_childrens('entries')
-        if entry_name in l.keys():
-            e = l[entry_name]
-        else:
+        e = self._entry_for_path(entry_name)
+        if e is None:
             print 'No entry with that name!'
             return
 
-        if not what in ['username', 'password', 'url']:
-            raise NotImplementedError
-
+        value = getattr(e, what)
+        if not isinstance(value, basestring):
+            value = unicode(value or '')
         try:
-            pyperclip.copy(getattr(e, what))
-            print "%s copied into clipboard!" % what
+            self.clipboard.copy(value or u'')
         except Exception, e:
             print "Cannot copy %s into clipboard: %s" % (what, e)
             return
-
+        if self.clipboard.timeout:
+            print "%s copied into clipboard (cleared in %d seconds)" % (
+                what, self.clipboard.timeout)
+        else:
+            print "%s copied into clipboard!" % what
         return
 
     def complete_open(self, text, line, begidx, endidx):
         """
         auto complete of file name.
         """
-        line = line.split()
-        if len(line) < 2:
-            filename = ''
-            path = './'
-        else:
-            path = line[1]
-            if '/' in path:
-                i = path.rfind('/')
-                filename = path[i+1:]
-                path = path[:i]
-            else:
-                filename = path
-                path = './'
-
-        ls = dircache.listdir(path)
-        ls = ls[:] # for overwrite in annotate.
-        dircache.annotate(path, ls)
-        if filename == '':
-            return ls
-        else:
-            return filter(lambda x: x.startswith(filename), ls)
+        token = line[line.rfind(' ', 0, endidx) + 1:endidx]
+        head = len(token) - len(text)
+        return [c[head:] for c in self.files.complete(token)]
 
     def do_open(self, line):
         """
-        Opens a kdb file
-        Usage: open FILENAME
+        Opens a kdb file, -r opens it read-only
+        Usage: open [-r] FILENAME
         """
-        self.db = self._open_db(path=line)
+        try:
+            opts, args = getopt.getopt(line.split(), 'r')
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not args:
+            print "Usage: open [-r] FILENAME"
+            return
+        path = os.path.expanduser(os.path.expandvars(' '.join(args)))
+        self._open_db(path=path, readonly=bool(opts))
         return
 
-    @db_opened
+    @db_writable
     def do_save(self, line=None):
         """
         Save an existing or new db
         Usage: save [FILENAME]
         """
         if line == '': line = None # horrible
+        if line: line = os.path.expanduser(os.path.expandvars(line))
             
         try:
             if not self.db.groups:
@@ -324,8 +1806,18 @@ class PkpCli(cmd.Cmd):
             print "Cannot create defaut groups to db: %s" % e
             
         try:
-            self.db.save(dbfile=line, password=self.db.password)
+            with self.stats.timer('save'):
+                self.db.save(dbfile=line, password=self.db.password)
             self.need_save = None
+            self.pending_changes = 0
+            self.dirty_since = None
+            if line:
+                # the vault (and its lock) moved to the new file
+                path = os.path.realpath(self.db.filepath)
+                self.vault.path = path
+                for name, p in self.closed_vaults.items():
+                    if p == path:
+                        del self.closed_vaults[name]
         except Exception, e:
             print "Cannot save db: %s" % e
             
@@ -334,7 +1826,7 @@ class PkpCli(cmd.Cmd):
     @db_opened
     def do_close(self, line):
         """
-        Close the current DB
+        Close the current DB (the previous one becomes current)
         Usage: close
         """
         self._close_db()
@@ -344,41 +1836,324 @@ class PkpCli(cmd.Cmd):
     @db_opened
     def do_ls(self, line):
         """
-        List content of the current group
-        Usage: ls
+        List content of the current group (or of GROUP)
+        Usage: ls [-R] [-l] [-t] [-r] [GROUP]
+            The last part of GROUP can be a glob filtering
+            what is listed (e.g. ls -R /Internet/web*).
+            Long listings are paged with $PAGER.
+            OPTIONS:
+                -R list the subgroups recursively
+                -l long listing (modification time and user)
+                -t sort by modification time, newest first
+                -r reverse the sort order
+        """
+        try:
+            o,a = getopt.getopt(line.split(), 'Rltr')
+        except getopt.GetoptError, e:
+            print e
+            return
+        opts = [k for k,v in o]
+        group, pattern = self._ls_target(' '.join(a))
+        if group is None:
+            print 'Group \'%s\' not found!' % ' '.join(a)
+            return
+        self._page(self._ls_lines(group, pattern, '-R' in opts, '-l' in opts,
+                                  '-t' in opts, '-r' in opts))
+        return
+
+    def _ls_target(self, path):
+        """
+        Returns (group, glob) for the argument of ls and tree:
+        the group at path, or its parent and its last part if
+        that is a glob. group is None if not found
+        """
+        if not path:
+            return self.cwd, None
+        group = self._group_for_path(path)
+        if group is not None:
+            return group, None
+        parent, title = self._split_path(path)
+        if parent is not None and EntryIndex.GLOB_CHARS.search(title):
+            return parent, title
+        return None, None
+
+    def _sorted_children(self, group, pattern=None, by_time=False, reverse=False):
+        """
+        Returns the subgroups and the entries of group (each
+        sorted by title or modification time) matching pattern
+        """
+        def select(items):
+            if pattern:
+                items = [i for i in items if fnmatch.fnmatchcase(i.title or '', pattern)]
+            if by_time:
+                return sorted(items, key=lambda i: i.modified, reverse=not reverse)
+            return sorted(items, key=lambda i: (i.title or '').lower(), reverse=reverse)
+        return select(group.children), select(group.entries)
+
+    def _ls_line(self, item, long=False):
+        if hasattr(item, 'children'):
+            name = "\033[1;36m{}/\033[1;m".format(item.title)
+            user = ''
+        else:
+            name, user = item.title, item.username or ''
+        if not long:
+            return name
+        modified = item.modified.strftime('%Y-%m-%d %H:%M') if item.modified else ''
+        return u'{:16}  {:20}  {}'.format(modified, user, name)
+
+    def _ls_lines(self, group, pattern=None, recursive=False, long=False,
+                  by_time=False, reverse=False):
+        """
+        Generator of the lines of ls: one group at a time, so that
+        only the children of the group being listed are in memory
+        """
+        stack = [group]
+        first = True
+        while stack:
+            g = stack.pop()
+            groups, entries = self._sorted_children(g, pattern, by_time, reverse)
+            if recursive:
+                # descend into all the subgroups, not only the matching ones
+                subgroups = self._sorted_children(g, None, by_time, reverse)[0]
+                stack.extend(reversed(subgroups))
+                if not (groups or entries):
+                    continue
+                if not first:
+                    yield ''
+                yield '%s:' % self._group_path(g)
+                first = False
+            for i in groups:
+                yield self._ls_line(i, long)
+            for i in entries:
+                yield self._ls_line(i, long)
+
+    @db_opened
+    def do_tree(self, line):
+        """
+        Shows the groups and the entries below GROUP
+        (default: current) as a tree
+        Usage: tree [-d] [GROUP]
+            OPTIONS:
+                -d show only the groups
+        """
+        try:
+            o,a = getopt.getopt(line.split(), 'd')
+        except getopt.GetoptError, e:
+            print e
+            return
+        group = self._group_for_path(' '.join(a)) if a else self.cwd
+        if group is None:
+            print 'Group \'%s\' not found!' % ' '.join(a)
+            return
+        def lines():
+            yield self._group_path(group)
+            for l in self._tree_lines(group, '', bool(o)):
+                yield l
+        self._page(lines())
+        return
+
+    def _tree_lines(self, group, prefix, groups_only=False):
+        """
+        Generator of the lines of tree below group
+        """
+        groups, entries = self._sorted_children(group)
+        if groups_only:
+            entries = []
+        items = groups + entries
+        for n, i in enumerate(items):
+            last = n == len(items) - 1
+            yield prefix + ('`-- ' if last else '|-- ') + self._ls_line(i)
+            if hasattr(i, 'children'):
+                for l in self._tree_lines(i, prefix + ('    ' if last else '|   '),
+                                          groups_only):
+                    yield l
+
+    def _terminal_height(self):
+        try:
+            import fcntl
+            import termios
+            import struct
+            rows = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(),
+                                                   termios.TIOCGWINSZ, '1234'))[0]
+            return rows or 24
+        except (ImportError, IOError, AttributeError):
+            return 24
+
+    def _pager(self):
+        """
+        Returns the pager command: $PAGER, or less/more if found
+        """
+        if os.environ.get('PAGER'):
+            return os.environ['PAGER']
+        from distutils.spawn import find_executable
+        if find_executable('less'):
+            return 'less -FRX'
+        if find_executable('more'):
+            return 'more'
+        return None
+
+    def _page(self, lines):
+        """
+        Prints the lines produced by the generator lines. On a
+        terminal, if they do not fit in a screen, they are sent
+        through the pager as they are produced
+        """
+        import itertools
+
+        lines = iter(lines)
+        head = []
+        pager = None
+        if sys.stdout.isatty() and not self.batch:
+            pager = self._pager()
+        if pager:
+            height = self._terminal_height() - 1
+            for l in lines:
+                head.append(l)
+                if len(head) >= height:
+                    break
+            else:
+                pager = None
+        if not pager:
+            for l in itertools.chain(head, lines):
+                print l
+            return
+
+        import subprocess
+        p = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE)
+        try:
+            for n, l in enumerate(itertools.chain(head, lines)):
+                if isinstance(l, unicode):
+                    l = l.encode('utf-8')
+                p.stdin.write(l + '\n')
+                if n % 100 == 0:
+                    p.stdin.flush()
+        except IOError:
+            pass # the pager was closed
+        except KeyboardInterrupt:
+            print
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+            p.wait()
+
+    @db_opened
+    def do_cd(self, line):
+        """
+        Moves throught groups
+        Usage: cd [GROUP]
+            GROUP can be a path like /Internet/web or ../web,
+            VAULT:/Internet/web (or just VAULT:) moves to
+            another opened DB
+        """
+        m = self.VAULT_PREFIX.match(line)
+        if m:
+            vault = self._get_vault(m.group(1))
+            if vault is None:
+                print 'Vault %s not opened!' % m.group(1)
+                return
+            self._use(vault)
+            line = line[m.end():]
+            if not line:
+                return
+        if not line:
+            self.cwd = self.db.root
+            return
+        group = self._group_for_path(line)
+        if group is None:
+            print 'Group \'%s\' not found!' % line
+            return
+        self.cwd = group
+        return
+    
+    @db_opened
+    def do_find(self, line):
+        """
+        Find entries and groups in all the opened DBs
+        Usage: find [-p] [-fFIELD] QUERY
+               find -z [-nNUM] WORDS
+            Matches QUERY as substring of title, username,
+            url or notes (glob if it contains * ? or [ ]).
+            OPTIONS:
+                -p      prefix match
+                -fFIELD search only FIELD (can be repeated)
+                -z      best matches first of the WORDS, also
+                        misspelled or abbreviated, in the path,
+                        username and url (e.g. find -z prd dbadm)
+                -nNUM   number of matches of -z (default 20)
+        """
+        try:
+            o,a = getopt.getopt(line.split(), 'pf:zn:')
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not a:
+            print 'Usage: find [-p] [-fFIELD] QUERY'
+            return
+
+        opts = dict(o)
+        if '-z' in opts:
+            try:
+                limit = int(opts.get('-n', 20))
+            except ValueError:
+                print 'Invalid number of matches %s' % opts['-n']
+                return
+            self._page(p for s, p in self._find_fuzzy(' '.join(a), limit))
+            return
+        fields = [v for k,v in o if k == '-f'] or None
+        for v in self.vaults.values():
+            with self._using(v):
+                for p in self._find(' '.join(a), ('-p', '') in o, fields):
+                    if len(self.vaults) > 1:
+                        p = '%s:%s' % (v.name, p)
+                    print p
+        return
+
+    def do_vaults(self, line):
+        """
+        Lists the opened DBs (* is the current one) and the
+        ones closed while unused, that are reopened on use
+        Usage: vaults
         """
-        l = self._current_childrens()
-        
-        for key in l['groups']:
-            print "\033[1;36m{}/\033[1;m".format(key)
-            
-        for key in l['entries']:
-            print "{}".format(key)
-
-        return
+        for v in self.vaults.values():
+            flags = []
+            if v.db.readonly:
+                flags.append('read-only')
+            if v.need_save:
+                flags.append('not saved')
+            print '%s %s: %s %s' % ('*' if v is self.vault else ' ', v.name,
+                                    v.path, ' '.join(flags))
+        for name, path in sorted(self.closed_vaults.items()):
+            print '  %s: %s closed' % (name, path)
 
-    @db_opened
-    def do_cd(self, line):
+    def _find(self, text, prefix=False, fields=None):
         """
-        Moves throught groups
-        Usage: cd GROUP
+        Returns the sorted paths of the entries and groups
+        matching text (see EntryIndex)
         """
-        if not line or line == '/': 
-            self.cwd = self.db.root       
-        elif line == '..':
-            if self.cwd.title != '/':
-                self.cwd = self.cwd.parent
+        if prefix:
+            found = self.index.prefix(text, fields)
         else:
-            l = self._current_childrens('groups')
-            if line in l.keys():
-                self.cwd = l[line]
-        return
-    
-    def do_find(self, line):
+            found = self.index.query(text, fields)
+        return sorted(self._item_path(i) for i in found)
+
+    def _find_fuzzy(self, text, limit=20):
         """
-        find entry
+        Returns the (score, path) of the limit entries and groups
+        of all the opened DBs best matching text, best first
+        (see EntryIndex.fuzzy())
         """
-        raise NotImplementedError
+        found = []
+        for v in self.vaults.values():
+            with self._using(v):
+                for score, item in self.index.fuzzy(text, self._item_path, limit):
+                    p = self._item_path(item)
+                    if len(self.vaults) > 1:
+                        p = '%s:%s' % (v.name, p)
+                    found.append((score, p))
+        found.sort(key=lambda r: (-r[0], len(r[1]), r[1]))
+        return found[:limit]
 
     @db_opened
     def do_pwd(self, line):
@@ -386,18 +2161,7 @@ class PkpCli(cmd.Cmd):
         Prints full "path"
         Usage: pwd
         """
-        prompt_list = []
-        
-        def _pwd(group):
-            prompt_list.insert(0, group)
-            if group.title == '/':
-                return prompt_list
-            else:
-                return _pwd(group.parent)
-            
-        p = "/".join([x.title for x in _pwd(self.cwd)])
-        
-        print p
+        print self._group_path(self.cwd)
         return
  
     @db_opened
@@ -427,6 +2191,7 @@ class PkpCli(cmd.Cmd):
         
         return
     
+    @db_opened
     def do_cpu(self, line):
         """
         Copy username into clipboard
@@ -435,6 +2200,7 @@ class PkpCli(cmd.Cmd):
         self._attr_copy(what='username',entry_name=line)
         return
     
+    @db_opened
     def do_cpp(self, line):
         """
         Copy password into clipboard
@@ -443,6 +2209,7 @@ class PkpCli(cmd.Cmd):
         self._attr_copy(what='password',entry_name=line)
         return
 
+    @db_opened
     def do_cpurl(self, line):
         """
         Copy URL into clipboard
@@ -457,6 +2224,13 @@ class PkpCli(cmd.Cmd):
         (read/write/create/delete)
         
         """
+        import tempfile
+        import subprocess
+        try:
+            import ConfigParser
+        except ImportError:
+            from configparser import ConfigParser
+
         tmpfile = tempfile.NamedTemporaryFile('w+b', delete=False)
         editor = os.environ.get('EDITOR') # use fallback
 
@@ -502,7 +2276,6 @@ Note = {notes}
         c.read(tmpfile.name)
             
         entry.title = c.get('entry', 'Title')
-        entry.group = self.cwd
         entry.url = c.get('entry', 'Url')
         entry.username = c.get('entry', 'User')
         entry.notes = c.get('entry', 'Note')
@@ -517,56 +2290,63 @@ Note = {notes}
             
         return entry
 
-    @db_opened
+    @db_writable
     def do_new(self, line):
         """
-        Creates new entry in the current directory
+        Creates new entry in the current directory (or in the
+        group of the given path)
         Usage: new ENTRYNAME
         """
-        
-        l = self._current_childrens('entries')
-        if line in l.keys():
+        group, title = self._split_path(line)
+        if group is None:
+            print 'Cannot create %s: group not found' % line
+            return
+        l = self._childrens(group, 'entries')
+        if title in l:
             print 'Cannot create %s: already existing' % line
             print 'Try using \'edit\' instead...'
             return
         else:
-            if self.cwd.title == '/':
+            if group is self.db.root:
                 print 'Cannot create entry into the root group!'
                 return
             try:
                 _entry = self.db.create_entry(
-                    group=self.cwd,
-                    title=line,
+                    group=group,
+                    title=title,
                     url='Insert url',
                     username='Insert username',
                     notes='Insert notes',
                     )
+                # create_entry() does not bind the entry to its group
+                _entry.group = group
             except Exception, e:
                  print 'Cannot create entry: %s' % e
             _entry = self._external_edit(entry=_entry)
+            self._entry_added(_entry)
             print 'Entry %s created' % _entry.title
             print 'To set password use \'passwd %s\'' % _entry.title
-            self.need_save = True
+            self._mark_dirty()
             return
 
-    @db_opened
+    @db_writable
     def do_edit(self, line):
         """
         Edit an existing entry
         Usage: edit ENTRYNAME
         """
-        l = self._current_childrens('entries')
-        if line in l.keys():
-            _entry = l[line]
+        _entry = self._entry_for_path(line)
+        if _entry is not None:
             self._external_edit(entry=_entry)
-            self.need_save = True
+            self._entry_changed(_entry)
+            self._mark_dirty()
             print '[INFO] to change an entry\'s password use \'passwd\''
         else:
             print 'Entry does not exists, creating new one...'
             self.do_new(line)
         return
         
-    @db_opened
+    @db_writable
     def do_mkdir(self, line):
         """
         Creates new group
@@ -577,72 +2357,99 @@ Note = {notes}
             print 'Usage: mkdir GROUPNAME'
             return
 
-        p = None if self.cwd.title == '/' else self.cwd
-            
-        self.db.create_group(parent=p,title=line)
-        self.need_save = True
+        parent, title = self._split_path(line.rstrip('/'))
+        if parent is None:
+            print 'Cannot create %s: parent group not found' % line
+            return
+        if not title:
+            print 'Cannot create %s: empty group name' % line
+            return
+        if title in self._childrens(parent, 'groups'):
+            print 'Cannot create %s: group already exists' % line
+            return
+        p = None if parent is self.db.root else parent
 
-    def _generate_password(self, pw_len=8, special_chars=None):
+        g = self.db.create_group(parent=p,title=title)
+        self._group_added(g)
+        self._mark_dirty()
+
+    def _generate_password(self, opts):
         '''
-        Code stolen!
-        Simply return random password of given len
+        Returns a new password (or passphrase) as
+        asked by the do_passwd() options
         '''
-        import random
-
-        alphabet = "abcdefghijklmnopqrstuvwxyz"
-        special_c = '!@#$%^&*()'
-        upperalphabet = alphabet.upper()
-        pwlist = []
-
-        for i in range(pw_len//3):
-            pwlist.append(alphabet[random.randrange(len(alphabet))])
-            pwlist.append(upperalphabet[random.randrange(len(upperalphabet))])
-            if special_chars:
-                pwlist.append(special_c[random.randrange(len(special_c))])
-            pwlist.append(str(random.randrange(10)))
-        for i in range(pw_len-len(pwlist)):
-            pwlist.append(alphabet[random.randrange(len(alphabet))])
-        random.shuffle(pwlist)
-        pwstring = "".join(pwlist)
-        return pwstring
-        
-    @db_opened
+        if '-w' in opts:
+            return self.passwords.passphrase(words=int(opts['-w']),
+                                             wordlist=opts.get('-W'))
+        classes = opts.get('-c', 'lud')
+        if '-s' in opts and 's' not in classes:
+            classes += 's'
+        return self.passwords.password(length=int(opts.get('-l', 8)),
+                                       classes=classes)
+
+    @db_writable
     def do_passwd(self, line):
         '''
         Sets password to entries
-        Usage: passwd [-lNUM] [-s] ENTRY
+        Usage: passwd [-lNUM] [-s] [-cCLASSES] [-wNUM [-WFILE]] ENTRY
+               passwd --bulk [-R] [OPTIONS] GLOB
+            Without options the password is asked, otherwise
+            it is generated.
             OPTIONS:
-                -lNUM password lenght (NUM)
-                -s    use special characters (default No)
+                -lNUM     password lenght (NUM, default 8)
+                -s        use special characters (default No)
+                -cCLASSES use at least one character of each class:
+                          l(owercase) u(ppercase) d(igits) s(pecial)
+                          p(unctuation) (default lud)
+                -wNUM     passphrase of NUM words
+                -WFILE    wordlist for the passphrase
+                          (default /usr/share/dict/words)
+                --bulk    generate a new password for every entry
+                          of the group whose title matches GLOB (case
+                          sensitive); GLOB can start with a group path
+                          (e.g. /Internet/*)
+                -R        with --bulk, also the entries of all the
+                          groups below
         '''
-        o,a = getopt.getopt(line.split(), 'l:s')
-        
-        opts = dict()
-
-        pw_len = 8
-        special_chars = False
-        generate = False
+        try:
+            o,a = getopt.getopt(line.split(), 'l:sc:w:W:R', ['bulk'])
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not a:
+            print 'Usage: passwd [OPTIONS] ENTRY'
+            return
         
-        for k,v in o:
-            opts[k] = v
-        if opts.has_key('-l'):
-            pw_len = int(opts['-l'])
-            generate = True
-            print '[INFO] Generating password of %s chars' % pw_len
-        if opts.has_key('-s'):
-            special_chars = True
-            generate = True
+        opts = dict(o)
+        for c in opts.get('-c', ''):
+            if c not in PasswordGenerator.CLASSES:
+                print 'Unknown character class %s' % c
+                return
+        if '-R' in opts and '--bulk' not in opts:
+            print '-R needs --bulk'
+            return
+        generate = bool(set(opts) - set(['--bulk', '-R']))
+        if '-w' in opts:
+            print '[INFO] Generating passphrase of %s words' % opts['-w']
+        elif '-l' in opts:
+            print '[INFO] Generating password of %s chars' % opts['-l']
+        if '-s' in opts:
             print '[INFO] Using special chars'
 
-        l = self._current_childrens('entries')
-        if a[0] in l.keys():
-            _entry = l[a[0]]
-        else:
+        if '--bulk' in opts:
+            return self._bulk_passwd(a[0], opts)
+
+        _entry = self._entry_for_path(a[0])
+        if _entry is None:
             print 'Cannot find entry %s ' % a[0]
             return
 
         if generate:
-            password = self._generate_password(pw_len=pw_len, special_chars=special_chars)
+            try:
+                password = self._generate_password(opts)
+            except ValueError, e:
+                print 'Cannot generate password: %s' % e
+                return
         else:
             p1 = getpass.getpass('Insert password for %s: ' % line)
             p2 = getpass.getpass('Repeat password: ')
@@ -654,13 +2461,162 @@ Note = {notes}
 
         try:
             _entry.password = password
+            self._entry_changed(_entry, reindex=False)
             print 'Password set successfully'
-            self.do_save()
+            self._mark_dirty()
         except Exception, e:
             'Cannot set password for %s: %s' % (_entry.title, e)
             return
-    
+
+    def _bulk_passwd(self, pattern, opts):
+        '''
+        Generates a new password for all the entries of the
+        group matching pattern, like cp and mv do (see _sources()),
+        or of the whole subtree with -R (see do_passwd()). They
+        are saved at once by the write-back policy
+        '''
+        group = self.cwd
+        if '/' in pattern:
+            path, pattern = pattern.rsplit('/', 1)
+            group = self._group_for_path(path or '/')
+            if group is None:
+                print 'Group %s not found!' % path
+                return
+        groups = self._walk(group) if '-R' in opts else [group]
+        entries = [e for g in groups for e in g.entries
+                   if fnmatch.fnmatchcase(e.title or u'', pattern or '*')]
+        if not entries:
+            print 'No entries matching %s' % pattern
+            return
+        m = 'Do you want to change the password of %d entries (y/N)? ' % len(entries)
+        if not self._confirm(message=m, default=False):
+            return
+        try:
+            for entry in entries:
+                entry.password = self._generate_password(opts)
+                self._entry_changed(entry, reindex=False)
+                self._mark_dirty()
+        except ValueError, e:
+            print 'Cannot generate password: %s' % e
+            return
+        print 'Password set for %d entries' % len(entries)
+
+    AUDIT_WEAK = 40 # bits, see password_strength()
+    AUDIT_FAIR = 60
+    AUDIT_POOL = 20000 # distinct passwords worth a process pool
+    SEVERITIES = ('low', 'medium', 'high')
+
     @db_opened
+    def do_audit(self, line):
+        """
+        Checks the entries below the current group (or GROUP)
+        for empty, weak or reused passwords and for expired
+        entries; the problems are listed most severe first
+        Usage: audit [-jNUM] [GROUP]
+            OPTIONS:
+                -jNUM score the passwords with NUM processes
+                      (default one per CPU on large DBs)
+        """
+        import hashlib
+        import datetime
+
+        try:
+            o,a = getopt.getopt(line.split(), 'j:')
+        except getopt.GetoptError, e:
+            print e
+            return
+        opts = dict(o)
+        try:
+            jobs = int(opts.get('-j', 0))
+        except ValueError:
+            print 'Invalid number of processes %s' % opts['-j']
+            return
+        group = self.cwd
+        if a:
+            group = self._group_for_path(' '.join(a))
+            if group is None:
+                print 'Group \'%s\' not found!' % ' '.join(a)
+                return
+
+        # entries by hash of the password: every distinct password
+        # is scored once and the reused ones are the lists of two
+        # or more entries (the hashes stay in memory)
+        entries = [e for g in self._walk(group) for e in g.entries]
+        shared = dict()
+        for e in entries:
+            key = hashlib.sha256((e.password or u'').encode('utf-8')).digest()
+            shared.setdefault(key, []).append(e)
+        keys = shared.keys()
+        passwords = [shared[k][0].password or u'' for k in keys]
+        try:
+            scores = self._password_scores(passwords, jobs)
+        except KeyboardInterrupt:
+            print 'Interrupted'
+            return
+        strength = dict(zip(keys, scores))
+
+        now = datetime.datetime.now()
+        results = []
+        for key, same in shared.iteritems():
+            bits = strength[key]
+            for e in same:
+                severity = 0
+                issues = []
+                if not e.password:
+                    severity = 2
+                    issues.append('empty password')
+                elif bits < self.AUDIT_WEAK:
+                    severity = 2
+                    issues.append('weak password (%d bits)' % bits)
+                elif bits < self.AUDIT_FAIR:
+                    issues.append('fair password (%d bits)' % bits)
+                if e.password and len(same) > 1:
+                    severity = max(severity, 1)
+                    issues.append('shared with %d other entries' % (len(same) - 1))
+                # entries that never expire have a date far in the future
+                if e.expires and e.expires < now:
+                    severity = max(severity, 1)
+                    issues.append('expired on %s' % e.expires.strftime('%Y-%m-%d'))
+                if issues:
+                    results.append((severity, issues, self._item_path(e)))
+        results.sort(key=lambda r: (-r[0], -len(r[1]), r[2]))
+
+        def lines():
+            for severity, issues, path in results:
+                yield u'{:6}  {:40}  {}'.format(self.SEVERITIES[severity], path,
+                                                u', '.join(issues))
+            counts = [sum(1 for r in results if r[0] == s) for s in (2, 1, 0)]
+            yield ('%d entries checked: %d high, %d medium, %d low'
+                   % tuple([len(entries)] + counts))
+        self._page(lines())
+
+    def _password_scores(self, passwords, jobs=0):
+        """
+        Returns password_strength() of every password, computed
+        by jobs processes (by default one per CPU if there are
+        at least AUDIT_POOL passwords, else in this process)
+        """
+        import multiprocessing
+
+        if not jobs:
+            jobs = 1
+            if len(passwords) >= self.AUDIT_POOL:
+                jobs = multiprocessing.cpu_count()
+        if jobs < 2:
+            return map(password_strength, passwords)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            result = pool.map_async(password_strength, passwords,
+                                    max(1, len(passwords) // (jobs * 4)))
+            # a timeout, so that ^C can interrupt the wait (py2)
+            scores = result.get(3600)
+            pool.close()
+            return scores
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @db_writable
     def do_rm(self, line):
         """
         Delete an entry
@@ -670,17 +2626,17 @@ Note = {notes}
             print 'Usage: rm ENTRY'
             return
 
-        e = self._current_childrens('entries')
-        if not line in e.keys():
+        _entry = self._entry_for_path(line)
+        if _entry is None:
             print 'Entry %s not found!' % line
             return
-        _entry = e[line]
         m = 'Do you want to remove \'%s\' (y/N)? ' % line
         if self._confirm(message=m, default=False):
             try:
                 self.db.remove_entry(entry=_entry)
+                self._entry_removed(_entry)
                 print 'Entry \'%s\' removed' % line
-                self.need_save = True
+                self._mark_dirty()
             except Exception, e:
                 print 'Cannot remove entry %s: %s' % (line, e)
             finally:
@@ -688,7 +2644,7 @@ Note = {notes}
         else:
             return
 
-    @db_opened
+    @db_writable
     def do_rmdir(self, line):
         """
         Delete a group
@@ -699,17 +2655,20 @@ Note = {notes}
             print 'Usage: rmgroup GROUPNAME'
             return
 
-        g = self._current_childrens('groups')
-        if not line in g.keys():
+        _group = self._group_for_path(line)
+        if _group is None or _group is self.db.root:
             print 'Group \'%s\' not found!' % line
             return
-        _group = g[line]
         m = "Do you want to remove \'%s\' and all it's entries now (y/N)? " % line
         if self._confirm(message=m,default=False):            
             try:
+                items = self._subtree(_group)
                 self.db.remove_group(group=_group)
+                self._group_removed(items)
+                if self.cwd in items:
+                    self.cwd = self.db.root
                 print 'Group \'%s\' removed!' % line
-                self.need_save = True
+                self._mark_dirty()
             except Exception, e:
                 print 'Cannot remove group %s: %s' % (line, e)
             finally:
@@ -717,11 +2676,703 @@ Note = {notes}
         else:
             return
 
+    def _resolve(self, path):
+        """
+        Splits VAULT:path in (vault, path); paths without the
+        prefix of an opened (or closed) vault are in the current one
+        """
+        m = self.VAULT_PREFIX.match(path)
+        if m and (m.group(1) in self.vaults or m.group(1) in self.closed_vaults):
+            return self._get_vault(m.group(1)), path[m.end():]
+        return self.vault, path
+
+    def _sources(self, path):
+        """
+        Returns the entries and groups at path (in the current
+        vault); the last part of path can be a glob
+        """
+        path = path.rstrip('/') or '/'
+        group, title = self._split_path(path)
+        if group is None:
+            return []
+        if not EntryIndex.GLOB_CHARS.search(title):
+            item = self._group_for_path(path)
+            if item is None:
+                item = self._entry_for_path(path)
+            return [item] if item is not None else []
+        l = self._childrens(group)
+        return ([l['groups'][t] for t in sorted(l['groups']) if fnmatch.fnmatchcase(t, title)] +
+                [l['entries'][t] for t in sorted(l['entries']) if fnmatch.fnmatchcase(t, title)])
+
+    def _clone_entry(self, entry, group, title=None):
+        """
+        Copies entry (of any DB) in group of the current one
+        """
+        e = self.db.create_entry(group=group, title=title or entry.title,
+                                 icon=entry.icon, username=entry.username,
+                                 password=entry.password, url=entry.url,
+                                 notes=entry.notes, expires=entry.expires,
+                                 binary_desc=entry.binary_desc,
+                                 binary=entry.binary)
+        # create_entry() does not bind the entry to its group
+        e.group = group
+        # the setters above touched the modification time
+        e.created, e.modified, e.accessed = entry.created, entry.modified, entry.accessed
+        self._entry_added(e)
+        return e
+
+    def _clone_group(self, group, parent, title=None):
+        """
+        Copies group (of any DB) with all its subgroups and
+        entries below parent in the current DB
+        """
+        p = None if parent is self.db.root else parent
+        g = self.db.create_group(parent=p, title=title or group.title,
+                                 icon=group.icon, expires=group.expires)
+        g.created, g.modified, g.accessed = group.created, group.modified, group.accessed
+        self._group_added(g)
+        for e in group.entries:
+            self._clone_entry(e, g)
+        for child in group.children:
+            self._clone_group(child, g)
+        return g
+
+    def _remove_item(self, item):
+        """
+        Removes an entry or a group (and everything
+        below it) from the current DB
+        """
+        if hasattr(item, 'children'):
+            items = self._subtree(item)
+            self.db.remove_group(group=item)
+            self._group_removed(items)
+            if self.cwd in items:
+                self.cwd = self.db.root
+        else:
+            self.db.remove_entry(entry=item)
+            self._entry_removed(item)
+
+    def _move_item(self, item, group, title):
+        """
+        Moves an entry or a group to group (in the same DB).
+        Returns False if it cannot be moved
+        """
+        try:
+            if hasattr(item, 'children'):
+                old = item.parent
+                if item.parent is not group:
+                    self.db.move_group(item, group)
+                item.title = title
+                self._group_moved(item, old)
+            else:
+                old = item.group
+                if item.group is not group:
+                    self.db.move_entry(item, group)
+                item.title = title
+                self._entry_moved(item, old)
+        except Exception, e:
+            print 'Cannot move %s: %s' % (item.title, e)
+            return False
+        return True
+
+    def _copy(self, line, move=False):
+        """
+        Implements do_cp() and do_mv()
+        """
+        name = 'mv' if move else 'cp'
+        args = line.split()
+        if len(args) < 2:
+            print 'Usage: %s SOURCE... DEST' % name
+            return
+
+        dvault, dpath = self._resolve(args[-1])
+        if dvault is None:
+            return
+        sources = []
+        for arg in args[:-1]:
+            vault, path = self._resolve(arg)
+            if vault is None:
+                return
+            with self._using(vault):
+                found = self._sources(path)
+            if not found:
+                print '%s not found!' % arg
+                return
+            sources.extend((vault, i) for i in found)
+
+        with self._using(dvault):
+            if self.db.readonly:
+                print '%s: database opened read-only!' % dvault.name
+                return
+            dgroup, title = self._group_for_path(dpath), None
+            if dgroup is None:
+                if len(sources) > 1:
+                    print 'Group %s not found!' % args[-1]
+                    return
+                dgroup, title = self._split_path(dpath.rstrip('/'))
+                if dgroup is None:
+                    print 'Group %s not found!' % args[-1]
+                    return
+
+        changed = set()
+        for vault, item in sources:
+            if move and vault.db.readonly:
+                print '%s: database opened read-only!' % vault.name
+                continue
+            is_group = hasattr(item, 'children')
+            if item is vault.db.root:
+                print 'Cannot %s the root group' % name
+                continue
+            with self._using(dvault):
+                l = self._childrens(dgroup, 'groups' if is_group else 'entries')
+                t = title or item.title
+                if t in l:
+                    print 'Cannot %s %s: %s/%s already exists' % (
+                        name, item.title, self._group_path(dgroup).rstrip('/'), t)
+                    continue
+                if not is_group and dgroup is self.db.root:
+                    print 'Cannot create entry into the root group!'
+                    continue
+                if is_group and vault is dvault and dgroup in set(self._walk(item)):
+                    print 'Cannot %s %s inside itself' % (name, item.title)
+                    continue
+                if vault is dvault and move:
+                    if not self._move_item(item, dgroup, t):
+                        continue
+                elif is_group:
+                    self._clone_group(item, dgroup, t)
+                else:
+                    self._clone_entry(item, dgroup, t)
+                changed.add(dvault)
+            if move and vault is not dvault:
+                with self._using(vault):
+                    self._remove_item(item)
+                changed.add(vault)
+
+        # saved according to the write-back policy
+        for vault in changed:
+            with self._using(vault):
+                self._mark_dirty()
+        return
+
+    @db_opened
+    def do_cp(self, line):
+        """
+        Copies entries and groups (with everything below
+        them), also between opened DBs, or a field of an
+        entry into the clipboard
+        Usage: cp SOURCE... DEST
+               cp ENTRY FIELD
+            SOURCE and DEST can start with VAULT: and the
+            last part of SOURCE can be a glob (e.g. /Internet/*).
+            With a single SOURCE, DEST can also be the new path.
+            FIELD is one of title, username, password, url, notes,
+            created, modified, accessed or expires (unless a group
+            has that name): copy to ./FIELD to make a new entry.
+        """
+        args = line.split()
+        if (len(args) == 2 and args[1] in self.ENTRY_FIELDS and
+            self._group_for_path(args[1]) is None):
+            vault, path = self._resolve(args[0])
+            if vault is None:
+                return
+            with self._using(vault):
+                self._attr_copy(what=args[1], entry_name=path)
+            return
+        self._copy(line)
+
+    @db_opened
+    def do_mv(self, line):
+        """
+        Moves (or renames) entries and groups, also between
+        opened DBs
+        Usage: mv SOURCE... DEST
+            See cp
+        """
+        self._copy(line, move=True)
+
+    # what makes two entries with the same path different
+    MERGE_FIELDS = ('username', 'password', 'url', 'notes', 'expires',
+                    'binary_desc', 'binary')
+
+    def _other_vault(self, arg):
+        """
+        Returns the vault of arg for diff and merge: an opened
+        VAULT: or a DB file (opened read-only if not yet opened)
+        """
+        name = arg[:-1] if arg.endswith(':') else arg
+        if name in self.vaults or name in self.closed_vaults:
+            return self._get_vault(name)
+        path = os.path.expanduser(os.path.expandvars(arg))
+        if not os.path.isfile(path):
+            print 'No opened vault or DB file %s' % arg
+            return None
+        current = self.vault
+        if self._open_db(path, readonly=True) is None:
+            return None
+        vault = self.vault
+        self._use(current)
+        return vault
+
+    def _merge_index(self, vault):
+        """
+        Returns the entries of vault by (group path, title, n),
+        n numbering the entries with the same title in a group
+        """
+        index = OrderedDict()
+        with self._using(vault):
+            for g in self._walk(self.db.root):
+                path = self._group_path(g)
+                for e in g.entries:
+                    key = (path, e.title, 0)
+                    while key in index:
+                        key = (path, e.title, key[2] + 1)
+                    index[key] = e
+        return index
+
+    def _content_hash(self, entry):
+        """
+        Returns the digest of the MERGE_FIELDS of entry
+        """
+        import hashlib
+        h = hashlib.sha1()
+        for f in self.MERGE_FIELDS:
+            value = getattr(entry, f)
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif not isinstance(value, str):
+                value = str(value)
+            h.update('%d:' % len(value))
+            h.update(value)
+        return h.digest()
+
+    def _diff(self, other):
+        """
+        Generator of (status, key, entry here, entry in other)
+        comparing the current vault with other in one pass over
+        each: status is + (only in other), - (only here) or M
+        (different content). Keys are the ones of _merge_index()
+        """
+        ours = self._merge_index(self.vault)
+        theirs = self._merge_index(other)
+        for key, e in ours.iteritems():
+            t = theirs.pop(key, None)
+            if t is None:
+                yield '-', key, e, None
+            elif self._content_hash(e) != self._content_hash(t):
+                yield 'M', key, e, t
+        for key, t in theirs.iteritems():
+            yield '+', key, None, t
+
+    def _newer(self, ours, theirs, other):
+        if ours.modified > theirs.modified:
+            return 'newer here'
+        if ours.modified < theirs.modified:
+            return 'newer in %s:' % other.name
+        return 'same time'
+
+    def _update_entry(self, entry, other):
+        """
+        Sets the content and the times of entry from other (of any DB)
+        """
+        for f in self.MERGE_FIELDS:
+            setattr(entry, f, getattr(other, f))
+        # the setters above touched the modification time
+        entry.modified, entry.accessed = other.modified, other.accessed
+        self._entry_changed(entry)
+
+    @db_opened
+    def do_diff(self, line):
+        """
+        Compares the entries of the current DB with the ones
+        of another DB, matched by group path and title
+        Usage: diff OTHER
+            OTHER is an opened VAULT: or a DB file (opened
+            read-only). Entries only in OTHER are marked +,
+            only here -, with a different content M.
+        """
+        if not line.strip():
+            print 'Usage: diff OTHER'
+            return
+        other = self._other_vault(line.strip())
+        if other is None:
+            return
+        if other is self.vault:
+            print 'Cannot compare a DB with itself'
+            return
+
+        def lines():
+            counts = {'+': 0, '-': 0, 'M': 0}
+            for status, key, ours, theirs in self._diff(other):
+                counts[status] += 1
+                path = u'{}/{}'.format(key[0].rstrip('/'), key[1])
+                if status == 'M':
+                    yield u'M {}  ({})'.format(path, self._newer(ours, theirs, other))
+                else:
+                    yield u'{} {}'.format(status, path)
+            yield '%d only in %s:, %d only here, %d changed' % (
+                counts['+'], other.name, counts['-'], counts['M'])
+        self._page(lines())
+
+    @db_writable
+    def do_merge(self, line):
+        """
+        Merges the entries of another DB into the current one,
+        that is saved once at the end
+        Usage: merge [-i] OTHER
+            OTHER is an opened VAULT: or a DB file (see diff).
+            Entries only in OTHER are copied (creating their
+            groups), changed ones take the content of the last
+            modified version. Entries only here are kept: with
+            no common ancestor, an entry deleted in OTHER cannot
+            be told from one added here.
+            OPTIONS:
+                -i ask which version to keep of every changed entry
+        """
+        try:
+            o,a = getopt.getopt(line.split(), 'i')
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not a:
+            print 'Usage: merge [-i] OTHER'
+            return
+        other = self._other_vault(' '.join(a))
+        if other is None:
+            return
+        if other is self.vault:
+            print 'Cannot merge a DB with itself'
+            return
+
+        added = updated = 0
+        try:
+            for status, key, ours, theirs in self._diff(other):
+                if status == '-':
+                    continue
+                if status == '+':
+                    self._clone_entry(theirs, self._group_for_path(key[0], create=True))
+                    added += 1
+                    continue
+                take = theirs.modified > ours.modified
+                if o:
+                    m = '%s/%s differs (%s). Take the one of %s: (%s)? ' % (
+                        key[0].rstrip('/'), key[1], self._newer(ours, theirs, other),
+                        other.name, 'Y/n' if take else 'y/N')
+                    take = self._confirm(message=m, default=take)
+                if take:
+                    self._update_entry(ours, theirs)
+                    updated += 1
+        except KeyboardInterrupt:
+            print 'Interrupted'
+        finally:
+            print '%d entries added, %d updated from %s:' % (added, updated, other.name)
+            if added or updated:
+                self._mark_dirty()
+                self.do_save()
+
+    EXCHANGE_FIELDS = ('group', 'title', 'username', 'password', 'url', 'notes')
+
+    def _exchange_format(self, opts, filename):
+        """
+        Returns the import/export format from -f or from
+        the file extension
+        """
+        fmt = opts.get('-f')
+        if not fmt:
+            fmt = os.path.splitext(filename)[1].lstrip('.')
+        fmt = fmt.lower()
+        if fmt == 'json':
+            fmt = 'jsonl'
+        if fmt not in ('csv', 'jsonl'):
+            print 'Unknown format \'%s\': use -fcsv or -fjsonl' % fmt
+            return None
+        return fmt
+
+    def _export_rows(self, group):
+        """
+        Generator of one dict per entry below group
+        """
+        for g in self._walk(group):
+            path = self._group_path(g)
+            for e in g.entries:
+                row = dict((f, getattr(e, f) or u'')
+                           for f in self.EXCHANGE_FIELDS if f != 'group')
+                row['group'] = path
+                yield row
+
+    def _read_rows(self, fp, fmt):
+        """
+        Generator of the dicts read from fp
+        """
+        import csv
+        import json
+        if fmt == 'csv':
+            for row in csv.DictReader(fp):
+                yield dict((k, (v or '').decode('utf-8'))
+                           for k,v in row.iteritems() if k)
+        else:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+
+    @db_opened
+    def do_export(self, line):
+        """
+        Export entries to a CSV or JSON Lines file
+        Usage: export [-fFORMAT] FILENAME [GROUP]
+            Exports all the entries below GROUP (default: current)
+            including passwords.
+            OPTIONS:
+                -fFORMAT csv or jsonl (default: from the extension)
+        """
+        import csv
+        import json
+
+        try:
+            o,a = getopt.getopt(line.split(), 'f:')
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not a:
+            print 'Usage: export [-fFORMAT] FILENAME [GROUP]'
+            return
+        fmt = self._exchange_format(dict(o), a[0])
+        if not fmt:
+            return
+        group = self.cwd
+        if len(a) > 1:
+            group = self._group_for_path(a[1])
+            if group is None:
+                print 'Group \'%s\' not found!' % a[1]
+                return
+
+        count = 0
+        try:
+            # the file contains passwords: not readable by others
+            fd = os.open(a[0], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'wb') as fp:
+                if fmt == 'csv':
+                    w = csv.DictWriter(fp, self.EXCHANGE_FIELDS)
+                    w.writeheader()
+                for row in self._export_rows(group):
+                    if fmt == 'csv':
+                        w.writerow(dict((k, v.encode('utf-8'))
+                                        for k,v in row.iteritems()))
+                    else:
+                        fp.write(json.dumps(row) + '\n')
+                    count += 1
+        except (IOError, OSError), e:
+            print 'Cannot export to %s: %s' % (a[0], e)
+            return
+        print '%d entries exported to %s' % (count, a[0])
+        return
+
+    @db_writable
+    def do_import(self, line):
+        """
+        Import entries from a CSV or JSON Lines file
+        Usage: import [-fFORMAT] FILENAME
+            Every record needs the group and title fields; username,
+            password, url and notes are optional. Missing groups are
+            created, entries already existing are skipped.
+            The DB is saved once at the end.
+            OPTIONS:
+                -fFORMAT csv or jsonl (default: from the extension)
+        """
+        import csv
+
+        try:
+            o,a = getopt.getopt(line.split(), 'f:')
+        except getopt.GetoptError, e:
+            print e
+            return
+        if not a:
+            print 'Usage: import [-fFORMAT] FILENAME'
+            return
+        fmt = self._exchange_format(dict(o), a[0])
+        if not fmt:
+            return
+
+        imported = skipped = 0
+        try:
+            with open(a[0], 'rb') as fp:
+                for n, row in enumerate(self._read_rows(fp, fmt), 1):
+                    path = (row.get('group') or '').strip('/')
+                    title = row.get('title')
+                    if not path or not title:
+                        print 'Record %d: group and title needed, skipped' % n
+                        skipped += 1
+                        continue
+                    group = self._group_for_path('/' + path, create=True)
+                    if title in self._childrens(group, 'entries'):
+                        skipped += 1
+                        continue
+                    entry = self.db.create_entry(
+                        group=group,
+                        title=title,
+                        username=row.get('username') or u'',
+                        password=row.get('password') or u'',
+                        url=row.get('url') or u'',
+                        notes=row.get('notes') or u'',
+                        )
+                    # create_entry() does not bind the entry to its group
+                    entry.group = group
+                    self._entry_added(entry)
+                    imported += 1
+        except (IOError, OSError, ValueError, csv.Error), e:
+            print 'Cannot import from %s: %s' % (a[0], e)
+        finally:
+            print '%d entries imported, %d skipped' % (imported, skipped)
+            if imported:
+                self._mark_dirty()
+                self.do_save()
+        return
+
+    JOURNAL_TIME = '%Y-%m-%d %H:%M:%S'
+    ENTRY_FIELDS = ('title', 'username', 'password', 'url', 'notes',
+                    'created', 'modified', 'accessed', 'expires')
+
+    def _entry_dict(self, entry, password=False):
+        """
+        Returns the fields of entry as a dict of strings
+        (the password only if asked)
+        """
+        d = dict(path=self._item_path(entry))
+        for f in self.ENTRY_FIELDS:
+            if f == 'password' and not password:
+                continue
+            value = getattr(entry, f)
+            d[f] = value if isinstance(value, basestring) else unicode(value or '')
+        return d
+
+    def _list(self, group):
+        """
+        Returns the names of the children of group,
+        groups first (with a trailing slash)
+        """
+        l = self._childrens(group)
+        return [g + '/' for g in l['groups']] + list(l['entries'])
+
+    def run_oneshot(self, opts, out=sys.stdout, err=sys.stderr):
+        """
+        Runs the single command parsed by oneshot_parser(),
+        writing machine-readable output (UTF-8 lines or JSON)
+        to out and errors to err. Returns the exit status
+        """
+        import json
+
+        if not self.db:
+            return 2
+
+        def emit(value):
+            if not isinstance(value, basestring):
+                value = json.dumps(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            out.write(value + '\n')
+
+        try:
+            with self.stats.timer('oneshot.' + opts.command):
+                return self._run_oneshot(opts, emit, err)
+        finally:
+            # also when serving: see postcmd()
+            self.db.evict()
+
+    def _run_oneshot(self, opts, emit, err):
+        if opts.command == 'get':
+            e = self._entry_for_path(opts.path)
+            if e is None:
+                print >>err, 'Entry %s not found!' % opts.path
+                return 1
+            d = self._entry_dict(e, password=opts.password or
+                                 opts.field == 'password')
+            emit(d[opts.field] if opts.field else d)
+        elif opts.command == 'ls':
+            group = self._group_for_path(opts.path)
+            if group is None:
+                print >>err, 'Group %s not found!' % opts.path
+                return 1
+            names = self._list(group)
+            if opts.json:
+                emit(names)
+            else:
+                for n in names:
+                    emit(n)
+        elif opts.command == 'find':
+            if opts.fuzzy:
+                paths = [p for s, p in self._find_fuzzy(' '.join(opts.query), opts.limit)]
+            else:
+                paths = self._find(' '.join(opts.query), opts.prefix, opts.field)
+            if opts.json:
+                emit(paths)
+            else:
+                for p in paths:
+                    emit(p)
+            if not paths:
+                return 1
+        return 0
+
+    def run_batch(self, script):
+        """
+        Runs the commands read from script (a file object)
+        without any interaction, then saves the DB once.
+        Empty lines and lines starting with # are skipped.
+        """
+        for line in script:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            line = self.precmd(line)
+            stop = self.onecmd(line)
+            stop = self.postcmd(stop, line)
+            if stop:
+                break
+        for v in self.vaults.values():
+            if v.need_save:
+                with self._using(v):
+                    self.do_save()
+        return
+
+    def do_stats(self, line):
+        """
+        Shows how many times the commands and the internal
+        operations ran and how long they took
+        Usage: stats [-r] [OPERATION]
+            With OPERATION shows its latency histogram.
+            OPTIONS:
+                -r reset the stats
+        """
+        if line.strip() == '-r':
+            self.stats.ops.clear()
+            return
+        if line:
+            if line not in self.stats.ops:
+                print 'No stats for %s' % line
+                return
+            lines = self.stats.histogram(line)
+        else:
+            lines = self.stats.report()
+        for l in lines:
+            print l
+
+    def dump_stats(self, path):
+        """
+        Writes the stats to path as JSON
+        """
+        import json
+        try:
+            with open(path, 'w') as fp:
+                json.dump(self.stats.to_dict(), fp, indent=2, sort_keys=True)
+        except IOError, e:
+            print 'Cannot write the stats to %s: %s' % (path, e)
+
     def do_EOF(self, line):
         """
         Exits
         """
-        self._close_db
+        self._close_all()
         return True
 
     def emptyline(self):
@@ -733,10 +3384,49 @@ Note = {notes}
     def postcmd(self, stop, line):
         """
         Override to simplify the prompt string creation
+        and to apply the write-back policy
         """
-        self._set_prompt()
+        with self.stats.timer('postcmd'):
+            self._flush()
+            self._evict()
+            for v in self.vaults.values():
+                v.db.evict()
+            self._set_prompt()
         return cmd.Cmd.postcmd(self, stop, line)
 
+    # these commands handle the VAULT: prefixes by themselves
+    VAULT_COMMANDS = ('cd', 'open', 'vaults', 'cp', 'mv', 'diff', 'merge')
+
+    def onecmd(self, line):
+        """
+        Timed version of _onecmd()
+        """
+        command = self.parseline(line)[0]
+        if not command:
+            return self._onecmd(line)
+        if not hasattr(self, 'do_' + command):
+            command = 'default'
+        with self.stats.timer('cmd.' + command):
+            return self._onecmd(line)
+
+    def _onecmd(self, line):
+        """
+        Runs a command whose paths all refer to one VAULT:
+        in that vault, without changing the current one
+        """
+        command = line.split(None, 1)[0] if line.strip() else ''
+        names = set(n for n in self.VAULT_PREFIX.findall(line)
+                    if n in self.vaults or n in self.closed_vaults)
+        if len(names) != 1 or command in self.VAULT_COMMANDS:
+            return cmd.Cmd.onecmd(self, line)
+        name = names.pop()
+        vault = self._get_vault(name)
+        if vault is None:
+            return
+        line = re.sub(r'(?<!\S)%s:' % re.escape(name), '', line)
+        with self._using(vault):
+            return cmd.Cmd.onecmd(self, line)
+
     def default(self, line):
         cmd, arg, line = self.parseline(line)
         func = [getattr(self, n) for n in self.get_names() if n.startswith('do_' + cmd)]
@@ -753,8 +3443,18 @@ Note = {notes}
     complete_edit = _complete_entries
     complete_passwd = _complete_entries
     complete_rm = _complete_entries
+    complete_cp = _complete_entries
+    complete_mv = _complete_entries
     complete_cd = _complete_groups
     complete_rmdir = _complete_groups
+    complete_ls = _complete_groups
+    complete_tree = _complete_groups
+    complete_audit = _complete_groups
+    complete_diff = complete_open
+    complete_merge = complete_open
+    complete_mkdir = _complete_groups
+    complete_new = _complete_groups
+    complete_save = complete_open
     do_cat = do_show
 
 if __name__ == '__main__':
@@ -762,11 +3462,108 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="CLI interface to KeePass DB files")
     parser.add_argument('-d','--database',metavar='DBFILE',help='Database file')
     parser.add_argument('-k','--keyfile',metavar='KEYFILE',help='The keyfile to use')
+    parser.add_argument('-r','--readonly',action='store_true',
+                        help='Open the database read-only')
+    parser.add_argument('--lock-timeout',metavar='SECONDS',type=float,default=0,
+                        help='Wait up to SECONDS for a database locked by another session')
+    parser.add_argument('-j','--journal',action='store_true',
+                        help='Journal the changes, so that they survive a crash before the save')
+    parser.add_argument('--max-vaults',metavar='N',type=int,default=8,
+                        help='Keep at most N databases opened (default 8)')
+    parser.add_argument('--vault-idle',metavar='SECONDS',type=int,default=0,
+                        help='Close the databases unused for SECONDS')
+    parser.add_argument('--clip-timeout',metavar='SECONDS',type=int,default=30,
+                        help='Clear the copied fields from the clipboard after '
+                        'SECONDS (default 30, 0 never)')
+    parser.add_argument('--stats',metavar='FILE',
+                        help='Write the latency stats (see the stats command) to FILE on exit')
+    parser.add_argument('-b','--batch',metavar='SCRIPT',
+                        help='Run the commands in SCRIPT (- for stdin) and exit')
+    parser.add_argument('--save-every',metavar='N',type=int,default=0,
+                        help='Save the database every N changes')
+    parser.add_argument('--save-interval',metavar='SECONDS',type=int,default=0,
+                        help='Save the database at the first command completed '
+                        'SECONDS after the first unsaved change (checked after '
+                        'each command, an idle shell does not save)')
+    parser.add_argument('--key-cache-ttl',metavar='SECONDS',type=int,default=0,
+                        help='Cache the derived keys for SECONDS (default 300 with --key-cache)')
+    parser.add_argument('--key-cache',metavar='FILE',
+                        help='Keep the derived keys cache in FILE between sessions')
+    parser.add_argument('--profile-startup',action='store_true',
+                        help='Print how long the startup and the imports took')
+    parser.add_argument('-s','--socket',metavar='PATH',
+                        help='Socket of the server (default %s); without -d '
+                        'the command is sent to the server' % DEFAULT_SOCKET)
+    parser.add_argument('command',nargs='?',choices=('get','ls','find','serve'),
+                        help='Run a single command and exit (see COMMAND -h), '
+                        'or serve them on the socket')
+    parser.add_argument('arguments',nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
     args = parser.parse_args()
-    c = PkpCli(db_path=args.database, db_key=args.keyfile)
+
+    out = sys.stdout
+    if args.command == 'serve':
+        p = argparse.ArgumentParser(prog='cli.py -d DBFILE serve',
+                                    description='Serve one-shot commands')
+        p.add_argument('-s','--socket',metavar='PATH',default=args.socket,
+                       help='Socket to listen on (default %s)' % DEFAULT_SOCKET)
+        args.socket = p.parse_args(args.arguments).socket
+    elif args.command:
+        argv = [args.command] + args.arguments
+        opts = oneshot_parser().parse_args(argv)
+        if not args.database:
+            sys.exit(client(args.socket or DEFAULT_SOCKET, argv))
+    if args.command:
+        if not args.database or not os.path.isfile(args.database):
+            parser.error('%s needs an existing database' % args.command)
+        # only the command output goes to stdout
+        sys.stdout = sys.stderr
+        # and they never write the DB, so they can share it
+        args.readonly = True
+
+    import logging
+    logging.basicConfig()
+
+    key_cache = None
+    if args.key_cache_ttl or args.key_cache:
+        import pkpdb
+        key_cache = pkpdb.KeyCache(ttl=args.key_cache_ttl or 300,
+                                   keyring=args.key_cache)
+    c = PkpCli(db_path=args.database, db_key=args.keyfile,
+               batch=bool(args.batch), save_every=args.save_every,
+               save_interval=args.save_interval, key_cache=key_cache,
+               readonly=args.readonly, lock_timeout=args.lock_timeout,
+               journal=args.journal, max_vaults=args.max_vaults,
+               vault_idle=args.vault_idle, clip_timeout=args.clip_timeout)
+    if args.profile_startup:
+        print_startup_profile()
+    if args.command:
+        try:
+            if args.command == 'serve':
+                status = serve(c, args.socket or DEFAULT_SOCKET) if c.db else 1
+            else:
+                status = c.run_oneshot(opts, out)
+        finally:
+            c._close_all()
+            if key_cache:
+                key_cache.close()
+            if args.stats:
+                c.dump_stats(args.stats)
+        sys.exit(status)
     try:
-        c.cmdloop()
+        if args.batch == '-':
+            c.run_batch(sys.stdin)
+        elif args.batch:
+            with open(args.batch) as script:
+                c.run_batch(script)
+        else:
+            c.cmdloop()
     except Exception, e:
         print 'Unexpected error!: %s' % e
     finally:
-        c._close_db()
+        c.clipboard.flush()
+        c._close_all()
+        if key_cache:
+            key_cache.close()
+        if args.stats:
+            c.dump_stats(args.stats)
@@ -0,0 +1,846 @@
+# -*- coding: utf-8 -*-
+"""
+Database layer of pkpcli: everything that needs keepassdb
+and its crypto backend lives here, so that cli.py can import
+it only when a DB is actually opened.
+"""
+import os
+import time
+import struct
+import errno
+import fcntl
+import socket
+import json
+import hmac
+import stat
+import base64
+import hashlib
+import binascii
+import logging
+import tempfile
+
+from keepassdb import LockingDatabase, util, const, exc
+from keepassdb.structs import HeaderStruct, GroupStruct, EntryStruct
+from keepassdb.model import Group, Entry, RootGroup
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+log = logging.getLogger('pkpcli')
+
+RootGroup.title = '/'
+
+class KeyCache(object):
+    """
+    Cache of the transformed master keys, so that opening and
+    saving a DB again with the same password skips the (slow)
+    key transformation rounds.
+
+    Keys expire after ttl seconds. If a keyring file is given the
+    cache is also stored there (mode 0600) and shared between
+    sessions; expired keys are dropped from it on load and on
+    close(). Entries are found and encrypted with keys derived
+    from the master key through LOOKUP_ROUNDS of PBKDF2: the file
+    alone opens nothing, and every password guess tested against
+    it costs those rounds. In memory the entries are kept in
+    buffers locked out of the swap (when mlock() is allowed).
+    """
+    LOOKUP_ROUNDS = 10000
+
+    def __init__(self, ttl=300, keyring=None):
+        self.ttl = ttl
+        self.keyring = keyring
+        self.keys = dict() # lookup -> (buffer of the encrypted key, expiration)
+        self.libc = None
+        self._lock_warned = False
+        if self.keyring:
+            self._load()
+
+    def _derive(self, masterkey, seed_key, rounds):
+        """
+        Returns the lookup and the encryption key of an entry
+        """
+        d = hashlib.pbkdf2_hmac('sha256', masterkey, seed_key + str(rounds),
+                                self.LOOKUP_ROUNDS, 64)
+        return binascii.hexlify(d[:32]), d[32:]
+
+    def _xor(self, data, key):
+        return ''.join(chr(ord(a) ^ ord(b)) for a, b in zip(data, key))
+
+    def _secure(self, data):
+        """
+        Returns data in a buffer locked in memory (best effort)
+        """
+        import ctypes
+        import ctypes.util
+        buf = ctypes.create_string_buffer(data, len(data))
+        try:
+            if self.libc is None:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                for func in libc.mlock, libc.munlock:
+                    func.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+                self.libc = libc
+            if self.libc.mlock(ctypes.addressof(buf), len(data)) != 0:
+                raise OSError(ctypes.get_errno(), 'mlock failed')
+        except (OSError, AttributeError), e:
+            if not self._lock_warned:
+                log.warning('Cannot lock the key cache in memory: %s', e)
+                self._lock_warned = True
+        return buf
+
+    def _drop(self, lookup):
+        import ctypes
+        buf, expires = self.keys.pop(lookup)
+        ctypes.memset(buf, 0, len(buf))
+        if self.libc:
+            self.libc.munlock(ctypes.addressof(buf), len(buf))
+
+    def _prune(self):
+        """
+        Drops the expired keys, returns how many
+        """
+        now = time.time()
+        expired = [l for l, (b, e) in self.keys.iteritems() if e <= now]
+        for lookup in expired:
+            self._drop(lookup)
+        return len(expired)
+
+    def _load(self):
+        try:
+            with open(self.keyring) as fp:
+                stored = json.load(fp)
+        except (IOError, ValueError):
+            return
+        now = time.time()
+        for lookup, (key, expires) in stored.iteritems():
+            if expires > now:
+                self.keys[lookup] = (self._secure(binascii.unhexlify(key)), expires)
+        if len(self.keys) < len(stored):
+            self._store()
+
+    def _store(self):
+        stored = dict((l, (binascii.hexlify(b.raw), e))
+                      for l, (b, e) in self.keys.iteritems())
+        try:
+            if stored:
+                atomic_write(self.keyring, json.dumps(stored))
+            elif os.path.exists(self.keyring):
+                os.remove(self.keyring)
+        except (IOError, OSError), e:
+            log.warning('Cannot write key cache %s: %s', self.keyring, e)
+
+    def get(self, masterkey, seed_key, rounds):
+        lookup, wrap = self._derive(masterkey, seed_key, rounds)
+        if lookup not in self.keys:
+            return None
+        buf, expires = self.keys[lookup]
+        if expires <= time.time():
+            self._drop(lookup)
+            return None
+        return self._xor(buf.raw, wrap)
+
+    def put(self, masterkey, seed_key, rounds, key):
+        lookup, wrap = self._derive(masterkey, seed_key, rounds)
+        if lookup in self.keys:
+            self._drop(lookup)
+        self.keys[lookup] = (self._secure(self._xor(key, wrap)), time.time() + self.ttl)
+        self._prune()
+        if self.keyring:
+            self._store()
+
+    def close(self):
+        """
+        Drops the expired keys (also from the keyring) and
+        wipes the others from memory
+        """
+        if self._prune() and self.keyring:
+            self._store()
+        for lookup in list(self.keys):
+            self._drop(lookup)
+
+
+def atomic_write(path, data):
+    """
+    Writes data to path through a synced temporary file renamed
+    over it, so that path holds either the old or the new contents
+    even if the write is interrupted. New files get mode 0600
+    """
+    path = os.path.realpath(path)
+    dirname, basename = os.path.split(path)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0600
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            os.fchmod(fp.fileno(), mode)
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, path)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    sync_dir(dirname)
+
+
+def sync_dir(dirname):
+    """
+    Makes the creation, removal or renaming of the
+    files in dirname durable
+    """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """
+    Append-only journal of the changes not yet saved to a DB,
+    kept in FILE.journal.
+
+    Every record is a JSON object encrypted (AES-CBC) and
+    authenticated (HMAC-SHA256) with keys derived from the final
+    key of the DB file. That key changes with every save, so a
+    journal left behind by an interrupted save (whose changes are
+    already in the DB) does not authenticate and is dropped, as
+    is a record torn by a crash while appending.
+    """
+    def __init__(self, path, final_key):
+        self.path = path
+        self.fp = None
+        self.size = 0
+        self.stale = False
+        self._set_key(final_key)
+
+    def _set_key(self, final_key):
+        self.enc_key = hashlib.sha256('pkpcli journal enc' + final_key).digest()
+        self.mac_key = hashlib.sha256('pkpcli journal mac' + final_key).digest()
+
+    def _decode(self, line):
+        try:
+            data = base64.b64decode(line)
+        except (TypeError, ValueError):
+            return None
+        if len(data) < 64 or (len(data) - 48) % 16:
+            return None
+        body, mac = data[:-32], data[-32:]
+        if not hmac.compare_digest(mac, hmac.new(self.mac_key, body, hashlib.sha256).digest()):
+            return None
+        return json.loads(util.decrypt_aes_cbc(body[16:], key=self.enc_key, iv=body[:16]))
+
+    def _encode(self, record):
+        iv = get_random_bytes(16)
+        body = iv + util.encrypt_aes_cbc(json.dumps(record), key=self.enc_key, iv=iv)
+        return base64.b64encode(body + hmac.new(self.mac_key, body, hashlib.sha256).digest())
+
+    def read(self):
+        """
+        Returns the valid records of the journal, stopping at the
+        first one that does not authenticate (stale is set if
+        there are none at all)
+        """
+        records = []
+        self.size = 0
+        try:
+            fp = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return records
+        with fp:
+            for line in fp:
+                record = line.endswith('\n') and self._decode(line.rstrip('\n'))
+                if not record:
+                    self.stale = not records
+                    if records:
+                        log.warning('Ignoring the damaged end of %s', self.path)
+                    break
+                records.append(record)
+                self.size += len(line)
+        return records
+
+    def truncate(self):
+        """
+        Drops everything after the valid records found by read()
+        (the whole file if there are none)
+        """
+        if self.size:
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(self.size)
+        else:
+            self.discard()
+
+    def append(self, record):
+        """
+        Appends record; it is durable only after sync()
+        """
+        if self.fp is None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            self.fp = os.fdopen(fd, 'ab')
+            sync_dir(os.path.dirname(os.path.realpath(self.path)))
+        self.fp.write(self._encode(record) + '\n')
+
+    def sync(self):
+        if self.fp is not None:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def discard(self):
+        """
+        Removes the journal (and its changes)
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.size = 0
+
+    def reset(self, final_key, path=None):
+        """
+        Starts over after a save with the new final key
+        (and path) of the DB
+        """
+        self.discard()
+        self.path = path or self.path
+        self.stale = False
+        self._set_key(final_key)
+
+
+def lock_owner(lockfile):
+    """
+    Returns (pid, host, timestamp) of the owner of the lock,
+    or None if not known (no lock, or an empty lock file
+    created by another program)
+    """
+    try:
+        with open(lockfile) as fp:
+            pid, host, timestamp = fp.read().split()
+        return int(pid), host, float(timestamp)
+    except (IOError, ValueError):
+        return None
+
+
+class LazyEntry(Entry):
+    """
+    Entry of a loaded DB that keeps only its uuid, title and
+    group, and where it is in the (still encrypted) content of
+    the file: the other fields are decrypted when first used
+    and dropped again by PkpDatabase.evict() unless changed.
+
+    Setting any attribute loads the entry and marks it dirty:
+    the clean ones are saved copying their bytes, the dirty
+    ones are serialized from their fields.
+    """
+    __slots__ = ('uuid', 'group_id', '_group', '_title', '_offset', '_length',
+                 '_loaded', '_dirty', '_icon', '_url', '_username', '_password',
+                 '_notes', 'created', 'modified', 'accessed', '_expires',
+                 'binary_desc', 'binary')
+    # the decrypted fields (struct attribute -> slot) and their defaults
+    LAZY = {'icon': '_icon', 'url': '_url', 'username': '_username',
+            'password': '_password', 'notes': '_notes', 'created': 'created',
+            'modified': 'modified', 'accessed': 'accessed', 'expires': '_expires',
+            'binary_desc': 'binary_desc', 'binary': 'binary'}
+    DEFAULTS = {'_icon': 1, '_url': u'', '_username': None, '_password': None,
+                '_notes': u'', '_expires': const.NEVER, 'binary_desc': u'',
+                'binary': b''}
+    LAZY_SLOTS = frozenset(LAZY.values())
+
+    log = logging.getLogger('keepassdb.model.Entry')
+
+    def __init__(self, uuid, group, title, offset, length):
+        init = object.__setattr__
+        init(self, 'uuid', uuid)
+        init(self, '_group', group)
+        init(self, 'group_id', group.id)
+        init(self, '_title', title)
+        init(self, '_offset', offset)
+        init(self, '_length', length)
+        init(self, '_loaded', False)
+        init(self, '_dirty', False)
+
+    def __getattr__(self, name):
+        # only called for the empty slots (and unknown names)
+        if name in self.LAZY_SLOTS and not self._loaded:
+            self._group.db.load_entry(self)
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not self._loaded:
+            self._group.db.load_entry(self)
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_dirty', True)
+
+    def _unload(self):
+        for name in self.LAZY_SLOTS:
+            object.__delattr__(self, name)
+        object.__setattr__(self, '_loaded', False)
+
+class PkpDatabase(LockingDatabase):
+    """
+    LockingDatabase that derives its keys through a KeyCache.
+
+    Unlike keepassdb, the transformation seed of an existing DB
+    is kept when saving as long as its transformed key is in the
+    key cache (the master seed and the IV are still renewed every
+    time); it is renewed once the key expires and on save as.
+
+    Read-only DBs never take the lock, so any number of them can
+    be opened next to a writer. Writers wait up to lock_timeout
+    seconds for a lock held by someone else; the lock file records
+    the pid, host and time of its owner so that locks left by
+    dead processes are detected and taken over. The lock is taken
+    before the file is read.
+
+    Files are saved atomically (see atomic_write()); once saved,
+    the journal, if any, is started over.
+
+    Entries are loaded as LazyEntry: the encrypted content of the
+    file is kept and the fields of an entry are decrypted only
+    when used (see load_entry() and evict()).
+    """
+    content = None # encrypted content of the file
+    loaded = ()    # LazyEntries with their fields decrypted
+    key_cache = None
+    stats = None
+    final_key = None
+    journal = None
+    lock_timeout = 0
+    lock_fd = None
+    stale_after = 24 * 3600 # age of a stale lock of another host
+
+    def __init__(self, dbfile=None, key_cache=None, lock_timeout=0, stats=None, **kwargs):
+        self.key_cache = key_cache
+        self.stats = stats
+        self.lock_timeout = lock_timeout
+        # keepassdb never sets the readonly flag (and _clear()
+        # resets it), so the lock would be taken anyway
+        self.readonly = kwargs.get('readonly', False)
+        super(PkpDatabase, self).__init__(dbfile, **kwargs)
+
+    def _record(self, name, start):
+        """
+        Records in the stats (see cli.Stats), if any, the time
+        elapsed since start by the phase name of a load or save
+        """
+        if self.stats:
+            self.stats.record('db.' + name, time.time() - start)
+
+    def _clear(self):
+        readonly = self.readonly
+        super(PkpDatabase, self)._clear()
+        self.readonly = readonly
+
+    def lock_owner(self):
+        """
+        See lock_owner()
+        """
+        return lock_owner(self.lockfile)
+
+    def lock_is_stale(self):
+        """
+        True if the process owning the lock is gone: checked with
+        its pid when on the same host, by age otherwise
+        """
+        owner = self.lock_owner()
+        if owner is None:
+            try:
+                age = time.time() - os.stat(self.lockfile).st_mtime
+            except OSError:
+                return False
+            return age > self.stale_after
+        pid, host, timestamp = owner
+        if host == socket.gethostname():
+            try:
+                os.kill(pid, 0)
+            except OSError, e:
+                return e.errno == errno.ESRCH
+            return False
+        return time.time() - timestamp > self.stale_after
+
+    def _take_over(self, force=False):
+        """
+        Takes over the lock file of a dead owner: its flock() is
+        held by its owner for as long as the lock is, so only one of
+        the processes racing for a stale lock gets it. Returns the
+        file descriptor, or None if the lock is not stale after all
+        """
+        try:
+            fd = os.open(self.lockfile, os.O_WRONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the lock may have been released (and taken again)
+            # since it was opened
+            if os.fstat(fd).st_ino != os.stat(self.lockfile).st_ino:
+                raise OSError(errno.ENOENT, 'lock file replaced')
+        except (IOError, OSError), e:
+            if not force or e.errno == errno.ENOENT:
+                os.close(fd)
+                return None
+        os.ftruncate(fd, 0)
+        log.warning('Took over stale lock file %s', self.lockfile)
+        return fd
+
+    def acquire_lock(self, force=False):
+        """
+        Takes out the lock, waiting (with an exponential backoff)
+        up to lock_timeout seconds for the current owner
+        """
+        if self.readonly:
+            raise exc.ReadOnlyDatabase()
+        if self._locked:
+            return
+        deadline = time.time() + self.lock_timeout
+        delay = 0.05
+        waiting = False
+        while True:
+            try:
+                fd = os.open(self.lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                fd = None
+                if force or self.lock_is_stale():
+                    fd = self._take_over(force)
+                    force = False
+                if fd is None:
+                    if time.time() >= deadline:
+                        raise exc.DatabaseAlreadyLocked('Lock file already exists: {0}'.format(self.lockfile))
+                    if not waiting:
+                        log.warning('Waiting for the lock %s', self.lockfile)
+                        waiting = True
+                    time.sleep(min(delay, max(deadline - time.time(), 0)))
+                    delay = min(delay * 2, 1)
+                    continue
+            os.write(fd, '%d %s %f\n' % (os.getpid(), socket.gethostname(), time.time()))
+            self.lock_fd = fd
+            self._locked = True
+            return
+
+    def release_lock(self, force=False):
+        """
+        See keepassdb.db.LockingDatabase.release_lock(); the file
+        is removed before its flock() is released
+        """
+        super(PkpDatabase, self).release_lock(force)
+        if self.lock_fd is not None and not self._locked:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def load(self, dbfile, password=None, keyfile=None, readonly=False):
+        """
+        See keepassdb.db.Database.load(); the lock is taken before
+        the file is read (keepassdb takes it after), so a writer that
+        waited for it reads what the previous owner saved
+        """
+        if self.readonly or hasattr(dbfile, 'read'):
+            return super(PkpDatabase, self).load(dbfile, password, keyfile, readonly)
+        self._clear()
+        if not os.path.exists(dbfile):
+            raise IOError("File does not exist: {0}".format(dbfile))
+        self.filepath = dbfile # takes the lock
+        try:
+            with open(dbfile, 'rb') as fp:
+                buf = fp.read()
+            self.load_from_buffer(buf, password=password, keyfile=keyfile, readonly=readonly)
+        except:
+            self.filepath = None
+            raise
+
+    def _masterkey(self, password=None, keyfile=None):
+        if password == '': password = None
+        if keyfile == '': keyfile = None
+        if password is None and keyfile is None:
+            raise ValueError("Password and/or keyfile is required.")
+        if password is None:
+            return util.key_from_keyfile(keyfile)
+        elif keyfile:
+            return hashlib.sha256(util.key_from_password(password) +
+                                  util.key_from_keyfile(keyfile)).digest()
+        return util.key_from_password(password)
+
+    def _final_key(self, header, password=None, keyfile=None):
+        """
+        Same as keepassdb.util.derive_key() but the transformed
+        key is looked up in (and added to) the key cache
+        """
+        masterkey = self._masterkey(password, keyfile)
+        seed_key, rounds = header.seed_key, header.key_enc_rounds
+        key = self.key_cache and self.key_cache.get(masterkey, seed_key, rounds)
+        if not key:
+            start = time.time()
+            key = masterkey
+            aes = AES.new(seed_key, AES.MODE_ECB)
+            for _i in xrange(rounds):
+                key = aes.encrypt(key)
+            key = hashlib.sha256(key).digest()
+            self._record('transform_key', start)
+            if self.key_cache:
+                self.key_cache.put(masterkey, seed_key, rounds, key)
+        return hashlib.sha256(header.seed_rand + key).digest()
+
+    def load_from_buffer(self, buf, password=None, keyfile=None, readonly=False):
+        """
+        See keepassdb.db.Database.load_from_buffer()
+        """
+        if password is None and keyfile is None:
+            raise ValueError("Password and/or keyfile is required.")
+
+        self.password = password
+        self.keyfile = keyfile
+
+        hdr_len = HeaderStruct.length
+        self.header = HeaderStruct(buf[:hdr_len])
+        crypted_content = buf[hdr_len:]
+
+        if self.header.version & const.DB_SUPPORTED_VERSION_MASK != const.DB_SUPPORTED_VERSION & const.DB_SUPPORTED_VERSION_MASK:
+            raise exc.UnsupportedDatabaseVersion('Unsupported file version: {0}'.format(hex(self.header.version)))
+        if not self.header.flags & HeaderStruct.AES:
+            raise exc.UnsupportedDatabaseEncryption('Only AES encryption is supported.')
+
+        final_key = self.final_key = self._final_key(self.header, password, keyfile)
+        start = time.time()
+        content = util.decrypt_aes_cbc(crypted_content, key=final_key,
+                                       iv=self.header.encryption_iv)
+        self._record('decrypt', start)
+
+        if ((len(content) > const.DB_MAX_CONTENT_LEN) or
+            (len(content) == 0 and self.header.ngroups > 0)):
+            raise exc.IncorrectKey("Decryption failed! The key is wrong or the file is damaged.")
+        if not self.header.contents_hash == hashlib.sha256(content).digest():
+            raise exc.AuthenticationError("Hash test failed. The key is wrong or the file is damaged.")
+
+        start = time.time()
+        offset = 0
+        for _i in range(self.header.ngroups):
+            # a buffer, not a copy of the rest of the content
+            gstruct = GroupStruct(buffer(content, offset))
+            self.groups.append(Group.from_struct(gstruct))
+            offset += len(gstruct)
+        self._bind_model()
+        groups = dict((g.id, g) for g in self.groups)
+        for _i in range(self.header.nentries):
+            entry, offset = self._scan_entry(content, offset, groups)
+            entry._group.entries.append(entry)
+            self.entries.append(entry)
+        self.content = crypted_content
+        self.loaded = set()
+        self._record('parse', start)
+
+    def _scan_entry(self, content, offset, groups):
+        """
+        Returns the LazyEntry at offset of the decrypted content
+        (decoding only its uuid, group and title) and the offset
+        of the next one
+        """
+        start = offset
+        fields = dict()
+        while True:
+            if offset + 6 > len(content):
+                raise exc.ParseError('Entry at offset %d is truncated' % start)
+            typ, size = struct.unpack_from('<HL', content, offset)
+            offset += 6 + size
+            if typ in (0x1, 0x2, 0x4):
+                fields[typ] = content[offset - size:offset]
+            elif typ == 0xFFFF:
+                break
+        group = groups.get(struct.unpack('<L', fields.get(0x2, '\0' * 4))[0])
+        if group is None:
+            raise NotImplementedError("Orphaned entries not (yet) supported.")
+        return LazyEntry(binascii.hexlify(fields.get(0x1, '')), group,
+                         fields.get(0x4, '').rstrip('\0').decode('utf-8'),
+                         start, offset - start), offset
+
+    def _decrypt(self, offset, length):
+        """
+        Returns length bytes at offset of the decrypted content,
+        decrypting only the AES blocks holding them
+        """
+        first = offset - offset % 16
+        end = offset + length
+        end += -end % 16
+        if first:
+            iv = self.content[first - 16:first]
+        else:
+            iv = self.header.encryption_iv
+        plain = AES.new(self.final_key, AES.MODE_CBC, iv).decrypt(self.content[first:end])
+        return plain[offset - first:offset - first + length]
+
+    def load_entry(self, entry):
+        """
+        Decrypts the fields of a LazyEntry (see evict())
+        """
+        raw = self._decrypt(entry._offset, entry._length)
+        init = object.__setattr__
+        for name, default in LazyEntry.DEFAULTS.iteritems():
+            init(entry, name, default)
+        # same as EntryStruct(raw), without its logging of every field
+        offset = 0
+        while offset + 6 <= len(raw):
+            typ, size = struct.unpack_from('<HL', raw, offset)
+            offset += 6 + size
+            name, marshall = EntryStruct.format.get(typ, (None, None))
+            if name in LazyEntry.LAZY:
+                init(entry, LazyEntry.LAZY[name], marshall.decode(raw[offset - size:offset]))
+        init(entry, '_loaded', True)
+        self.loaded.add(entry)
+
+    def evict(self):
+        """
+        Drops the decrypted fields of the entries loaded and not
+        changed since the last save
+        """
+        for entry in self.loaded:
+            if not entry._dirty:
+                entry._unload()
+        self.loaded = set(e for e in self.loaded if e._dirty)
+
+    def save(self, dbfile=None, password=None, keyfile=None):
+        """
+        See keepassdb.db.Database.save()
+        """
+        if self.readonly:
+            raise exc.ReadOnlyDatabase()
+
+        save_as = dbfile is not None and (hasattr(dbfile, 'write') or self.filepath is None or
+                                          os.path.realpath(dbfile) != os.path.realpath(self.filepath))
+        if dbfile is not None and not hasattr(dbfile, 'write'):
+            self.filepath = dbfile
+
+        if password is not None or self.keyfile is not None:
+            self.password = password
+            self.keyfile = keyfile
+        else:
+            raise ValueError("Password and/or keyfile is required.")
+
+        if self.filepath is None and dbfile is None:
+            raise ValueError("Unable to save without target file.")
+
+        start = time.time()
+        buf = bytearray()
+        for group in self.groups:
+            buf += group.to_struct().encode()
+        content = None
+        offsets = []
+        for entry in self.entries:
+            offset = len(buf)
+            if isinstance(entry, LazyEntry) and not entry._dirty:
+                if content is None:
+                    content = util.decrypt_aes_cbc(self.content, key=self.final_key,
+                                                   iv=self.header.encryption_iv)
+                buf += content[entry._offset:entry._offset + entry._length]
+            else:
+                buf += entry.to_struct().encode()
+            offsets.append((offset, len(buf) - offset))
+        content = None
+        buf = bytes(buf)
+        self._record('serialize', start)
+
+        header = HeaderStruct()
+        header.signature1 = const.DB_SIGNATURE1
+        header.signature2 = const.DB_SIGNATURE2
+        header.flags = header.AES
+        header.version = 0x00030002
+        # the transformation seed is kept only while its key is
+        # cached, and never shared with another file
+        if self.header and not save_as and self.key_cache and \
+           self.key_cache.get(self._masterkey(password, keyfile),
+                              self.header.seed_key, self.header.key_enc_rounds):
+            header.key_enc_rounds = self.header.key_enc_rounds
+            header.seed_key = self.header.seed_key
+        else:
+            header.key_enc_rounds = self.header.key_enc_rounds if self.header else 50000
+            header.seed_key = get_random_bytes(32)
+        header.encryption_iv = get_random_bytes(16)
+        header.seed_rand = get_random_bytes(16)
+        header.contents_hash = hashlib.sha256(buf).digest()
+        header.nentries = len(self.entries)
+        header.ngroups = len(self.groups)
+
+        final_key = self._final_key(header, password, keyfile)
+        start = time.time()
+        encrypted_content = util.encrypt_aes_cbc(buf, key=final_key,
+                                                 iv=header.encryption_iv)
+        self._record('encrypt', start)
+
+        start = time.time()
+        if hasattr(dbfile, 'write'):
+            dbfile.write(header.encode() + encrypted_content)
+        else:
+            atomic_write(self.filepath, header.encode() + encrypted_content)
+            if self.journal:
+                self.journal.reset(final_key, self.filepath + '.journal')
+        self._record('write', start)
+        self.header = header
+        self.final_key = final_key
+        # the clean entries are now found in the new content
+        self.content = encrypted_content
+        init = object.__setattr__
+        for entry, (offset, length) in zip(self.entries, offsets):
+            if isinstance(entry, LazyEntry):
+                init(entry, '_offset', offset)
+                init(entry, '_length', length)
+                init(entry, '_dirty', False)
+
+    def remove_group(self, group):
+        """
+        Same as keepassdb.db.Database.remove_group(), which skips
+        half of the subgroups and entries (it removes them from
+        the lists it is iterating), leaving orphaned entries that
+        make the saved file unreadable
+        """
+        for child in list(group.children):
+            self.remove_group(child)
+        for entry in list(group.entries):
+            self.remove_entry(entry)
+        group.parent.children.remove(group)
+        self.groups.remove(group)
+
+    def move_group(self, group, parent, index=None):
+        """
+        Same as keepassdb.db.Database.move_group(), which does
+        not update the levels of the moved groups (the saved file
+        would put them under the wrong parent) and cannot move
+        a group to the root one
+        """
+        if parent is None or parent is self.root:
+            if group not in self.groups:
+                raise exc.UnboundModelError("Group doesn't exist / is not bound to this database.")
+            group.parent.children.remove(group)
+            if index is None:
+                self.root.children.append(group)
+            else:
+                self.root.children.insert(index, group)
+            group.parent = self.root
+            group.modified = util.now()
+            self._rebuild_groups()
+        else:
+            super(PkpDatabase, self).move_group(group, parent, index)
+        stack = [group]
+        while stack:
+            g = stack.pop()
+            g.level = g.parent.level + 1
+            stack.extend(g.children)
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+        super(PkpDatabase, self).close()
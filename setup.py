@@ -29,7 +29,8 @@ setup(
     long_description = long_description,
     packages = ['keepassdb'],
     include_package_data=True,
-    install_requires=['pycrypto>=2.6,<3.0dev'],
+    install_requires=['pycrypto>=2.6,<3.0dev',
+                      'scandir>=1.5'],
     use_2to3=True,
     zip_safe=False # Technically it should be fine, but there are issues w/ 2to3 
 )